@@ -11,7 +11,9 @@ class BatchGenerator(object):
             self.reset()
 
         stop_index = self.index + batch_size
-        batch = self.data[self.index:stop_index]
+        # Copy, because reset() shuffles the data in place while the batch
+        # may still be waiting in a prefetch queue.
+        batch = self.data[self.index:stop_index].copy()
         self.index = stop_index
 
         return batch
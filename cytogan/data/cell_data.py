@@ -1,87 +1,100 @@
-import glob
 import os.path
 import re
+import threading
 
 import numpy as np
 import pandas as pd
-import tqdm
 
-from cytogan.data.image_loader import ImageLoader, AsyncImageLoader
+from cytogan.data.image_loader import (AsyncImageLoader, ImageCache,
+                                       ImageLoader, SharedBatchImageLoader)
+from cytogan.data import manifest
+from cytogan.data.samplers import StratifiedSampler, UniformSampler
+from cytogan.data.shards import ShardImageLoader
 from cytogan.extra import logs
 
 log = logs.get_logger(__name__)
 
 
+def _to_float_batch(images):
+    # Loaders hand out uint8 images, which we convert once per batch.
+    batch = np.array(images, dtype=np.float32)
+    batch /= 255.
+    return batch
+
+
 def _normalize_luminance(images):
-    normalized = []
-    for image in images:
-        maxima = image.max(axis=(0, 1))
-        if maxima.sum() > 0:
-            image /= maxima.reshape(1, 1, -1)
-        normalized.append(image)
-    return normalized
-
-
-def _make_one_hot_map(values):
-    one_hot_map = {}
-    size = len(values)
-    for index, value in enumerate(sorted(values)):
-        one_hot = np.zeros(size)
-        one_hot[index] = 1
-        one_hot_map[value] = one_hot
-
-    return one_hot_map
-
-
-def _image_key_for_path(path, root_path):
-    # We use the path relative to the root_path, without the file extension, as
-    # the image key.
-    relative_path = os.path.relpath(path, start=root_path)
-    return os.path.splitext(relative_path)[0]
-
-
-def _get_single_cell_names(root_path, plate_names, file_names, patterns):
-    assert os.path.isabs(root_path)
-    assert os.path.exists(root_path)
-    original_indices = []
-    single_cell_names = []
-    file_range = tqdm.tqdm(enumerate(zip(plate_names, file_names)))
-    file_range.unit = ' files'
-    for index, components in file_range:
-        image_path = os.path.join(*components)
-        if patterns and not any(p.search(image_path) for p in patterns):
-            continue
-        full_path = os.path.join(root_path, image_path)
-        assert os.path.isabs(full_path)
-        # We assume single-cell images are stored wit the original image name
-        # as prefix and then '-{digit}' suffixes, where {digit} is the id/number
-        # of the cell within the image.
-        glob_paths = glob.glob('{0}-*'.format(full_path))
-        image_keys = [_image_key_for_path(p, root_path) for p in glob_paths]
-        single_cell_names.extend(image_keys)
-        original_indices.extend([index] * len(image_keys))
-
-    return original_indices, single_cell_names
-
-
-def _load_single_cell_names_from_cell_count_file(metadata, cell_count_path):
+    # Scales every channel of every image by its maximum, leaving empty
+    # images and channels untouched.
+    if len(images) == 0:
+        return images
+    maxima = images.max(axis=(1, 2), keepdims=True)
+    np.place(maxima, maxima == 0, 1)
+    images /= maxima
+    return images
+
+
+def _make_labels(compounds, concentrations, concentration_only_labels):
+    # Each label is the concentration, followed by a one-hot encoding of the
+    # compound (in sorted order of the compounds) unless we only want the
+    # concentration.
+    concentrations = np.asarray(concentrations, dtype=np.float32)
+    if concentration_only_labels:
+        return concentrations.reshape(-1, 1)
+    codes, unique_compounds = pd.factorize(compounds, sort=True)
+    labels = np.zeros(
+        (len(codes), 1 + len(unique_compounds)), dtype=np.float32)
+    labels[:, 0] = concentrations
+    labels[np.arange(len(codes)), 1 + codes] = 1
+    return labels
+
+
+def _read_cell_count_file(cell_count_path):
     log.info('Using cell count file %s', cell_count_path)
-    indices = []
-    single_cell_names = []
-    with open(cell_count_path) as cell_count_file:
-        next(cell_count_file)  # skip header
-        for line in tqdm.tqdm(cell_count_file, unit=' files'):
-            key, count = line.split(',')
-            plate, file_name = key.split('/')
-            file_name += '.tif'
-            plate_index = metadata['Image_Metadata_Plate_DAPI'] == plate
-            file_index = metadata['Image_FileName_DAPI'] == file_name
-            index = metadata[plate_index & file_index].index[0]
-            for cell_index in range(int(count)):
-                indices.append(index)
-                single_cell_names.append('{0}-{1}'.format(key, cell_index))
-
-    return indices, single_cell_names
+    cell_counts = pd.read_csv(
+        cell_count_path, skipinitialspace=True, dtype={0: str})
+    cell_counts.columns = ['key', 'count']
+
+    return cell_counts
+
+
+def _count_cells_in_shards(shard_keys):
+    # Shard keys are single-cell keys of the form {image_key}-{cell_index}.
+    image_keys = pd.Series(shard_keys).str.rsplit('-', n=1).str[0]
+    counts = image_keys.value_counts(sort=False)
+    return pd.DataFrame(dict(key=counts.index, count=counts.values))
+
+
+def _load_single_cell_names_from_cell_counts(metadata, cell_counts):
+    # Join (plate, file) pairs of the count file against the metadata in one
+    # go, using the first metadata row for every pair.
+    plates_and_files = cell_counts['key'].str.split('/', n=1, expand=True)
+    counts = pd.DataFrame(
+        dict(
+            plate=plates_and_files[0].values,
+            file=plates_and_files[1].values + '.tif',
+            count=cell_counts['count'].values.astype(np.int64)))
+    rows = pd.DataFrame(
+        dict(
+            plate=metadata['Image_Metadata_Plate_DAPI'].values,
+            file=metadata['Image_FileName_DAPI'].values,
+            row=np.arange(len(metadata))))
+    rows.drop_duplicates(['plate', 'file'], inplace=True)
+    joined = counts.merge(rows, how='left', on=['plate', 'file'], sort=False)
+    missing = joined['row'].isnull()
+    if missing.any():
+        raise KeyError('No metadata for images {0}'.format(
+            list(cell_counts['key'][missing.values])))
+
+    counts = joined['count'].values
+    indices = np.repeat(joined['row'].values.astype(np.int64), counts)
+    # The n-th cell of an image gets the key {image_key}-{n}.
+    image_keys = np.repeat(cell_counts['key'].values, counts)
+    run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    cell_numbers = np.arange(len(indices)) - run_starts
+    single_cell_names = pd.Series(image_keys) + '-' + \
+        pd.Series(cell_numbers).astype(str)
+
+    return indices, list(single_cell_names)
 
 
 # Takes all metadata as a dataframe and returns a new dataframe with only the
@@ -89,42 +102,47 @@ def _load_single_cell_names_from_cell_count_file(metadata, cell_count_path):
 # - key (Image_Metadata_Plate_DAPI/Image_FileName_DAPI-0),
 # - compound
 # - concentration
+# along with a row-aligned float32 label matrix (or None without labels).
 # Note that for a particular image path in the original dataframe, we will not
 # actually use the path of that image, but of the single cell images, assumed to
 # have the original image name as a prefix.
 def _preprocess_metadata(metadata, patterns, root_path, cell_count_path,
-                         with_labels, concentration_only_labels):
+                         with_labels, concentration_only_labels,
+                         shard_keys=None, manifest_directory=None):
     plate_names = list(metadata['Image_Metadata_Plate_DAPI'])
     full_file_names = metadata['Image_FileName_DAPI']
     file_names = [os.path.splitext(name)[0] for name in full_file_names]
 
     log.info('Reading single-cell names')
-    if cell_count_path is None:
+    if cell_count_path is None and shard_keys is None:
         if patterns:
             assert not isinstance(patterns, str)
             patterns = [re.compile(pattern) for pattern in patterns]
-        indices, image_keys = _get_single_cell_names(root_path, plate_names,
-                                                     file_names, patterns)
+        indices, image_keys = manifest.get_single_cell_names(
+            root_path, plate_names, file_names, patterns,
+            manifest_directory or manifest.DEFAULT_DIRECTORY)
     else:
-        indices, image_keys = _load_single_cell_names_from_cell_count_file(
-            metadata, cell_count_path)
+        if cell_count_path is None:
+            cell_counts = _count_cells_in_shards(shard_keys)
+        else:
+            cell_counts = _read_cell_count_file(cell_count_path)
+        indices, image_keys = _load_single_cell_names_from_cell_counts(
+            metadata, cell_counts)
 
     compounds = metadata['Image_Metadata_Compound'].iloc[indices]
     concentrations = metadata['Image_Metadata_Concentration'].iloc[indices]
 
-    data = dict(compound=list(compounds), concentration=list(concentrations))
-    if with_labels:
-        labels = np.expand_dims(concentrations, 1)
-        if not concentration_only_labels:
-            one_hot = _make_one_hot_map(set(compounds))
-            one_hot_compounds = [one_hot[c] for c in compounds]
-            labels = np.concatenate([labels, one_hot_compounds], axis=1)
-        data['label'] = list(labels)
-
+    data = dict(compound=compounds.values, concentration=concentrations.values)
     processed = pd.DataFrame(data=data, index=image_keys)
     processed.index.name = 'key'
 
-    return processed
+    if with_labels:
+        labels = _make_labels(compounds.values, concentrations.values,
+                              concentration_only_labels)
+    else:
+        labels = None
+
+    return processed, labels
 
 
 class CellData(object):
@@ -136,62 +154,131 @@ class CellData(object):
                  patterns=None,
                  normalize_luminance=False,
                  with_labels=False,
-                 concentration_only_labels=False):
-        self.image_root = os.path.realpath(image_root)
+                 concentration_only_labels=False,
+                 shard_path=None,
+                 image_shape=None,
+                 shared_memory_batch_size=None,
+                 image_cache_size=None,
+                 manifest_directory=None,
+                 seed=None,
+                 rank=0,
+                 world_size=1,
+                 sampler='uniform'):
+        self.image_cache = None
+        if shard_path is None:
+            self.image_root = os.path.realpath(image_root)
+            if image_cache_size is not None:
+                self.image_cache = ImageCache(image_cache_size)
+            if shared_memory_batch_size is None:
+                self.images = AsyncImageLoader(
+                    self.image_root, cache=self.image_cache)
+            else:
+                # Batches live in shared memory, so only the synchronous
+                # loader goes through the cache.
+                assert image_shape is not None
+                self.images = SharedBatchImageLoader(
+                    self.image_root, image_shape, shared_memory_batch_size)
+            self.sync_images = ImageLoader(
+                self.image_root, cache=self.image_cache)
+            shard_keys = None
+        else:
+            # Shards are memory-mapped, so the same loader serves both
+            # prefetched batches and in-order lookups.
+            self.image_root = None
+            self.images = ShardImageLoader(shard_path)
+            self.sync_images = self.images
+            shard_keys = self.images.keys
 
         self.moa = pd.read_csv(labels_file_path)
         self.moa.set_index(['compound', 'concentration'], inplace=True)
 
         all_metadata = pd.read_csv(metadata_file_path)
-        self.metadata = _preprocess_metadata(
+        self.metadata, self.labels = _preprocess_metadata(
             all_metadata, patterns, self.image_root, cell_count_path,
-            with_labels, concentration_only_labels)
-
-        unique_treatments = set(map(tuple, self.metadata.values[:, :-1]))
+            with_labels, concentration_only_labels, shard_keys,
+            manifest_directory)
+
+        # Dense, row-aligned arrays for everything we touch per batch. The
+        # metadata frame is kept around for the (rarer) evaluation lookups.
+        self.keys = np.array(self.metadata.index, dtype=object)
+        self.key_index = pd.Index(self.keys)
+        self.compound_codes, self.compound_names = pd.factorize(
+            self.metadata['compound'], sort=True)
+        self.concentration_codes, self.concentration_values = pd.factorize(
+            self.metadata['concentration'], sort=True)
+
+        treatment_codes = self._treatment_codes(np.arange(len(self.keys)))
         log.info('Have {0:,} single-cell images for {1} unique '
                  '(compound, concentration) pairs with {2} MOA labels'.format(
-                     len(self.metadata), len(unique_treatments),
+                     len(self.metadata), len(np.unique(treatment_codes)),
                      len(self.moa)))
 
-        self.images = AsyncImageLoader(self.image_root)
-        self.sync_images = ImageLoader(self.image_root)
         self.normalize_luminance = normalize_luminance
+        # The iterator state is fully described by the seed, the epoch and the
+        # position within the epoch (see get_state/set_state).
+        if seed is None:
+            # All ranks must agree on the order, so they need a common seed.
+            assert world_size == 1, 'Need a seed for sharded iteration'
+            seed = np.random.randint(2**31)
+        # Every rank iterates over its own disjoint shard of each epoch.
+        if sampler == 'stratified':
+            # Balances batches across (compound, concentration) pairs, which
+            # would otherwise be dominated by the DMSO controls.
+            self.sampler = StratifiedSampler(treatment_codes, rank,
+                                             world_size, seed)
+        else:
+            assert sampler == 'uniform', sampler
+            self.sampler = UniformSampler(
+                len(self.keys), rank, world_size, seed)
+        log.info('Sampling images with %s', self.sampler)
+        # Guards epoch, batch_index and order, which get_state() may read
+        # while another thread advances them.
+        self.state_lock = threading.Lock()
+        self.epoch = 0
         self.batch_index = 0
+        # The order in which we iterate over the rows in the current epoch.
+        self.order = self._order_for_epoch(self.epoch)
         self.batches_with_labels = with_labels
 
         log.info('Yielding image batches with labels: %d', with_labels)
 
     @property
     def number_of_images(self):
-        return self.metadata.shape[0]
+        return len(self.keys)
+
+    @property
+    def images_per_epoch(self):
+        return self.sampler.shard_size
 
     @property
     def number_of_compounds(self):
-        return len(self.metadata['compound'].unique())
+        return len(self.compound_names)
 
     @property
     def label_shape(self):
         assert self.batches_with_labels
-        return (self.metadata['label'].iloc[0].shape[0], )
+        return self.labels.shape[1:]
 
     def next_batch(self, number_of_images, with_keys=False):
         last_index = self.batch_index + number_of_images
-        keys = self.metadata.iloc[self.batch_index:last_index].index
-        ok_keys, ok_images = self.images[keys]
+        rows = self.order[self.batch_index:last_index]
+        ok_keys, ok_images = self.images[self.keys[rows]]
 
-        self.batch_index = last_index
-        if self.batch_index >= self.number_of_images:
-            self.reset_batching_state()
+        with self.state_lock:
+            self.batch_index = last_index
+            if self.batch_index >= len(self.order):
+                self._start_next_epoch()
 
-        next_keys = self.metadata.iloc[
-            self.batch_index:self.batch_index + number_of_images].index
-        self.images.fetch_async(next_keys)
+        next_rows = self.order[self.batch_index:
+                               self.batch_index + number_of_images]
+        self.images.fetch_async(self.keys[next_rows])
 
+        ok_images = _to_float_batch(ok_images)
         if self.normalize_luminance:
             ok_images = _normalize_luminance(ok_images)
 
         if self.batches_with_labels:
-            values = ok_images, self.labels_for(ok_keys)
+            values = ok_images, self._labels_for_rows(rows, ok_keys)
         else:
             values = ok_images
 
@@ -199,23 +286,62 @@ class CellData(object):
             return ok_keys, values
         return values
 
+    def iterate_rows(self):
+        # Yields rows forever, one at a time, advancing the same iterator
+        # state as next_batch (used to feed input pipelines).
+        while True:
+            with self.state_lock:
+                row = self.order[self.batch_index]
+                self.batch_index += 1
+                if self.batch_index >= len(self.order):
+                    self._start_next_epoch()
+            yield row
+
     def reset_batching_state(self):
+        with self.state_lock:
+            self._start_next_epoch()
+
+    def _start_next_epoch(self):
+        self.epoch += 1
         self.batch_index = 0
-        # https://stackoverflow.com/questions/29576430/shuffle-dataframe-rows
-        self.metadata = self.metadata.sample(frac=1)
+        self.order = self._order_for_epoch(self.epoch)
+
+    def get_state(self):
+        with self.state_lock:
+            return dict(
+                seed=int(self.sampler.seed),
+                epoch=int(self.epoch),
+                batch_index=int(self.batch_index),
+                rank=self.sampler.rank,
+                world_size=self.sampler.world_size)
+
+    def set_state(self, state):
+        log.info('Resuming data iteration at epoch %d, image %d',
+                 state['epoch'], state['batch_index'])
+        # The position is only meaningful within a shard of the same size.
+        world_size = state.get('world_size', 1)
+        assert world_size == self.sampler.world_size, world_size
+        with self.state_lock:
+            self.sampler.seed = state['seed']
+            self.epoch = state['epoch']
+            self.order = self._order_for_epoch(self.epoch)
+            self.batch_index = state['batch_index']
 
     def batches_of_size(self, batch_size):
-        self.reset_batching_state()
+        # Evaluation always covers every image, in metadata order, and leaves
+        # the (sharded) training iteration alone.
         for start in range(0, self.number_of_images, batch_size):
             end = start + batch_size
-            keys = self.metadata.iloc[start:end].index
-            keys, images = self.images[keys]
-            next_keys = self.metadata.iloc[end:end + batch_size].index
-            self.images.fetch_async(next_keys)
+            rows = np.arange(start, min(end, self.number_of_images))
+            keys, images = self.images[self.keys[rows]]
+            next_rows = np.arange(end, min(end + batch_size,
+                                           self.number_of_images))
+            self.images.fetch_async(self.keys[next_rows])
+            images = _to_float_batch(images)
             if self.normalize_luminance:
                 images = _normalize_luminance(images)
             if self.batches_with_labels:
-                yield keys, (images, self.labels_for(keys))
+                yield keys, (images, self._labels_for_rows(rows, keys))
             else:
                 yield keys, images
 
@@ -225,6 +351,7 @@ class CellData(object):
             assert fetched_keys == keys
         else:
             _, images = self.images[keys]
+        images = _to_float_batch(images)
         if self.normalize_luminance:
             return _normalize_luminance(images)
         else:
@@ -252,17 +379,28 @@ class CellData(object):
         return dataset
 
     def labels_for(self, keys):
-        return list(self.metadata.loc[keys]['label'])
+        return self.labels[self.rows_for(keys)]
+
+    def rows_for(self, keys):
+        rows = self.key_index.get_indexer(list(keys))
+        assert (rows >= 0).all(), 'Unknown keys'
+        return rows
 
     def sample_labels(self, amount):
-        return self.metadata['label'].sample(amount)
+        rows = np.random.choice(self.number_of_images, amount, replace=False)
+        return self.labels[rows]
 
     def get_treatment_indices(self, keys):
-        filtered = self.metadata.loc[keys][['compound', 'concentration']]
-        compounds = list(set(map(tuple, filtered.values.tolist())))
-        index_map = {(com, con): i for i, (com, con) in enumerate(compounds)}
-        indices = filtered.apply(lambda row: index_map[tuple(row)], axis=1)
-        compound_strings = ['{}/{}'.format(com, con) for com, con in compounds]
+        treatment_codes = self._treatment_codes(self.rows_for(keys))
+        treatments, indices = np.unique(treatment_codes, return_inverse=True)
+        number_of_concentrations = len(self.concentration_values)
+        compound_strings = []
+        for treatment in treatments:
+            compound_code, concentration_code = divmod(
+                treatment, number_of_concentrations)
+            compound_strings.append('{}/{}'.format(
+                self.compound_names[compound_code],
+                self.concentration_values[concentration_code]))
 
         return compound_strings, indices
 
@@ -283,3 +421,18 @@ class CellData(object):
 
     def parse_algebra_spec(self, spec):
         pass
+
+    def _order_for_epoch(self, epoch):
+        # Depends only on the seed, the epoch and our shard.
+        return self.sampler.indices(epoch)
+
+    def _treatment_codes(self, rows):
+        # A single integer code for each (compound, concentration) pair.
+        return (self.compound_codes[rows] * len(self.concentration_values) +
+                self.concentration_codes[rows])
+
+    def _labels_for_rows(self, rows, ok_keys):
+        if len(ok_keys) == len(rows):
+            return self.labels[rows]
+        # Some images failed to load, so look up the ones that did.
+        return self.labels_for(ok_keys)
@@ -1,8 +1,9 @@
 import collections
+import functools
 import multiprocessing
 import os.path
 import signal
-import time
+import threading
 
 import numpy as np
 import scipy.misc
@@ -14,7 +15,9 @@ log = logs.get_logger(__name__)
 
 def load_image(root_path, image_key, extension):
     full_path = os.path.join(root_path, '{0}.{1}'.format(image_key, extension))
-    image = scipy.misc.imread(full_path).astype(np.float32) / 255.
+    # Images stay uint8 until they are stacked into a batch by the consumer,
+    # which keeps them 4x smaller while they cross process boundaries.
+    image = scipy.misc.imread(full_path).astype(np.uint8)
     # Expand a 2-D grayscale image into a 3-D image.
     if np.ndim(image) == 2:
         image = np.expand_dims(image, axis=-1)
@@ -22,6 +25,64 @@ def load_image(root_path, image_key, extension):
     return image
 
 
+class ImageCache(object):
+    '''A thread-safe LRU cache of decoded images with a byte budget.'''
+
+    def __init__(self, max_bytes=None):
+        # No budget means the cache grows without bound.
+        self.max_bytes = max_bytes
+        self.images = collections.OrderedDict()
+        self.size_in_bytes = 0
+        # Lookups served from the cache.
+        self.hits = 0
+        # Images that had to be decoded and were then put into the cache.
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.images
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            self.misses += 1
+            if key in self.images:
+                self.images.move_to_end(key)
+                return
+            if self.max_bytes is not None and image.nbytes > self.max_bytes:
+                return
+            self.images[key] = image
+            self.size_in_bytes += image.nbytes
+            while self.max_bytes is not None and \
+                    self.size_in_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.size_in_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.size_in_bytes = 0
+
+    def __repr__(self):
+        return ('ImageCache<{0:,} images, {1:,}/{2} bytes, {3:,} hits, '
+                '{4:,} misses, {5:,} evictions>').format(
+                    len(self.images), self.size_in_bytes, self.max_bytes,
+                    self.hits, self.misses, self.evictions)
+
+
 class AsyncImageLoader(object):
     '''Asynchronous image loader with prefetching function.'''
 
@@ -37,66 +98,240 @@ class AsyncImageLoader(object):
             signal.signal(signal.SIGINT, signal.SIG_IGN)
             return load_image(self.root_path, key, self.extension)
 
-    def __init__(self, root_path, extension='png'):
-        self.futures = {}
+    def __init__(self,
+                 root_path,
+                 extension='png',
+                 max_in_flight=1024,
+                 cache=None):
         self.pool = multiprocessing.Pool()
+        self.cache = cache
         self.load_job = AsyncImageLoader.Job(root_path, extension)
+        self.max_in_flight = max_in_flight
+        # Keys waiting for a free slot, in the order they were requested.
+        self.pending = collections.deque()
+        # Keys that are pending, being loaded, or loaded but not yet consumed.
+        self.requested = set()
+        # Completed loads, mapping each key to an (image, error) pair.
+        self.results = {}
+        self.number_in_flight = 0
+        # Guards all of the above and is notified whenever a load completes.
+        self.condition = threading.Condition()
 
     def __getitem__(self, image_keys):
-        want = list(image_keys.copy())
+        image_keys = list(image_keys)
+        self.fetch_async(image_keys)
         got_keys, got_images = [], []
-        # We'll be iterating over `want` and removing elements from it during
-        # iteration, so we cannot use a normal iterator or it will be
-        # invalidated.
-        index = 0
-        # Note: this is a simple spin-loop. It asssumes that batches are
-        # reasonably small and image loads reasonably fast so that we don't eat
-        # up too much CPU spinning around. A more complete implementation would
-        # use a condition variable, semaphore or a way of aggregating the
-        # futures to make the calling thread actually block and sleep rather
-        # than spin.
-        while want:
-            key = want[index]
-            future = self.futures.get(key)
-            if future is None:
-                # Haven't started fetching this image yet at all.
-                self.fetch_async([key])
-                index += 1
-            elif future.ready():
-                # The value of the future is either the image or an exception.
-                try:
-                    image = future.get()
-                    got_keys.append(key)
-                    got_images.append(image)
-                except IOError as error:
-                    log.error(error)
-                del want[index]
-                # Free memory.
-                del self.futures[key]
+        for key in image_keys:
+            with self.condition:
+                image, error = None, None
+                if key not in self.requested and self.cache is not None:
+                    image = self.cache.get(key)
+                if image is None:
+                    # Happens if the same key appears more than once in a
+                    # batch, or if it fell out of the cache.
+                    if key not in self.requested:
+                        self._request([key])
+                    while key not in self.results:
+                        self.condition.wait()
+                    image, error = self.results.pop(key)
+                    self.requested.discard(key)
+            if error is None:
+                got_keys.append(key)
+                got_images.append(image)
+            elif isinstance(error, IOError):
+                log.error(error)
             else:
-                # Job is still pending.
-                index += 1
-            # Wrap around.
-            if index == len(want):
-                index = 0
-                time.sleep(0.005)
+                raise error
 
         return got_keys, got_images
 
     def fetch_async(self, image_keys):
+        with self.condition:
+            self._request(image_keys)
+
+    def _request(self, image_keys):
+        # Must be called with self.condition held.
         for key in image_keys:
-            future = self.pool.apply_async(self.load_job, [key])
-            self.futures[key] = future
+            if key in self.requested:
+                continue
+            if self.cache is not None and key in self.cache:
+                continue
+            self.requested.add(key)
+            self.pending.append(key)
+        self._submit_pending()
+
+    def _submit_pending(self):
+        # Must be called with self.condition held.
+        while self.pending and self.number_in_flight < self.max_in_flight:
+            key = self.pending.popleft()
+            self.number_in_flight += 1
+            self.pool.apply_async(
+                self.load_job, [key],
+                callback=functools.partial(self._on_done, key),
+                error_callback=functools.partial(self._on_error, key))
+
+    def _on_done(self, key, image):
+        self._complete(key, image, None)
+
+    def _on_error(self, key, error):
+        self._complete(key, None, error)
+
+    def _complete(self, key, image, error):
+        # Runs on the pool's result handler thread.
+        if error is None and self.cache is not None:
+            self.cache.put(key, image)
+        with self.condition:
+            self.results[key] = (image, error)
+            self.number_in_flight -= 1
+            self._submit_pending()
+            self.condition.notify_all()
+
+
+# The shared batch buffers, inherited by every worker of a
+# SharedBatchImageLoader pool.
+_shared_buffers = None
+
+
+def _set_shared_buffers(buffers):
+    global _shared_buffers
+    _shared_buffers = buffers
+
+
+def _buffer_view(buffer, image_shape):
+    return np.frombuffer(buffer, dtype=np.uint8).reshape((-1, ) + image_shape)
+
+
+class SharedBatchImageLoader(object):
+    '''
+    Asynchronous image loader where each worker loads an entire batch straight
+    into a shared-memory buffer.
+
+    Batches are returned as views into these buffers, which stay valid only
+    until the next call to __getitem__. Copy them if they need to live longer.
+    '''
+
+    class Job(object):
+        '''Functor to circumvent limitations by multiprocessing.'''
+
+        def __init__(self, root_path, extension, image_shape):
+            self.root_path = root_path
+            self.extension = extension
+            self.image_shape = image_shape
+
+        def __call__(self, buffer_index, keys):
+            # Ignore KeyboardInterrupt inside the worker processes.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            view = _buffer_view(_shared_buffers[buffer_index],
+                                self.image_shape)
+            ok_keys, errors = [], []
+            for key in keys:
+                try:
+                    image = load_image(self.root_path, key, self.extension)
+                except IOError as error:
+                    errors.append(repr(error))
+                else:
+                    # Pack loaded images densely so that failures leave no
+                    # holes in the batch.
+                    view[len(ok_keys)] = image
+                    ok_keys.append(key)
+            return ok_keys, errors
+
+    def __init__(self,
+                 root_path,
+                 image_shape,
+                 max_batch_size,
+                 number_of_buffers=3,
+                 extension='png'):
+        self.image_shape = tuple(image_shape)
+        self.max_batch_size = max_batch_size
+        buffer_size = max_batch_size * int(np.prod(image_shape))
+        self.buffers = [
+            multiprocessing.RawArray('B', buffer_size)
+            for _ in range(number_of_buffers)
+        ]
+        self.pool = multiprocessing.Pool(
+            initializer=_set_shared_buffers, initargs=(self.buffers, ))
+        self.load_job = SharedBatchImageLoader.Job(root_path, extension,
+                                                   self.image_shape)
+        self.free_buffers = collections.deque(range(number_of_buffers))
+        # Maps a tuple of keys to the (buffer_index, AsyncResult) loading it.
+        self.futures = collections.OrderedDict()
+        # The buffer backing the batch we handed out last.
+        self.lent_buffer = None
+
+    def __getitem__(self, image_keys):
+        image_keys = tuple(image_keys)
+        self._reclaim_lent_buffer()
+        if len(image_keys) > self.max_batch_size:
+            return self._get_oversized_batch(image_keys)
+        if image_keys not in self.futures:
+            # Whatever else is in flight was prefetched for nothing.
+            self._drain()
+            self.fetch_async(image_keys)
+        buffer_index, future = self.futures.pop(image_keys)
+        ok_keys, errors = future.get()
+        for error in errors:
+            log.error(error)
+        self.lent_buffer = buffer_index
+        view = _buffer_view(self.buffers[buffer_index], self.image_shape)
+
+        return ok_keys, view[:len(ok_keys)]
+
+    def fetch_async(self, image_keys):
+        image_keys = tuple(image_keys)
+        if not image_keys or image_keys in self.futures:
+            return
+        if len(image_keys) > self.max_batch_size:
+            # Prefetch the chunks that __getitem__ will load them in.
+            for start in range(0, len(image_keys), self.max_batch_size):
+                self.fetch_async(image_keys[start:start + self.max_batch_size])
+            return
+        if not self.free_buffers:
+            # Prefetching is best effort. The batch will be loaded when it is
+            # actually requested.
+            return
+        buffer_index = self.free_buffers.popleft()
+        future = self.pool.apply_async(self.load_job,
+                                       [buffer_index, image_keys])
+        self.futures[image_keys] = (buffer_index, future)
+
+    def _reclaim_lent_buffer(self):
+        if self.lent_buffer is not None:
+            self.free_buffers.append(self.lent_buffer)
+            self.lent_buffer = None
+
+    def _drain(self):
+        for buffer_index, future in self.futures.values():
+            future.wait()
+            self.free_buffers.append(buffer_index)
+        self.futures.clear()
+
+    def _get_oversized_batch(self, image_keys):
+        all_keys, all_images = [], []
+        for start in range(0, len(image_keys), self.max_batch_size):
+            chunk = image_keys[start:start + self.max_batch_size]
+            ok_keys, images = self[chunk]
+            all_keys.extend(ok_keys)
+            # Copy, since the next chunk reuses the buffer.
+            all_images.append(images.copy())
+        self._reclaim_lent_buffer()
+
+        return all_keys, np.concatenate(all_images, axis=0)
 
 
 class ImageLoader(object):
     '''A basic, synchronous image loader with caching functionality.'''
 
-    def __init__(self, root_path, extension='png', cache=False):
+    def __init__(self, root_path, extension='png', cache=None):
         self.root_path = root_path
         self.extension = extension
-        self.loaded_images = {}
-        self.do_cache = cache
+        # Either an ImageCache (possibly shared with other loaders), True for
+        # an unbounded cache of our own, or None/False for no caching.
+        if cache is True:
+            cache = ImageCache()
+        elif cache is False:
+            cache = None
+        self.cache = cache
 
     def __getitem__(self, image_key):
         if isinstance(image_key, collections.Iterable):
@@ -104,15 +339,16 @@ class ImageLoader(object):
         return self.get_image(image_key)
 
     def clear(self):
-        self.loaded_images.clear()
+        if self.cache is not None:
+            self.cache.clear()
 
     def get_image(self, image_key):
-        if not self.do_cache:
+        if self.cache is None:
             return load_image(self.root_path, image_key, self.extension)
-        image = self.loaded_images.get(image_key)
+        image = self.cache.get(image_key)
         if image is None:
             image = load_image(self.root_path, image_key, self.extension)
-            self.loaded_images[image_key] = image
+            self.cache.put(image_key, image)
         return image
 
     def get_all_images(self, image_keys):
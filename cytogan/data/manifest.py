@@ -0,0 +1,174 @@
+import collections
+import hashlib
+import multiprocessing.pool
+import os
+import os.path
+
+import numpy as np
+
+from cytogan.extra import logs
+
+log = logs.get_logger(__name__)
+
+# Bump this whenever the layout of the manifest file changes.
+MANIFEST_VERSION = 2
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'cytogan')
+
+# A manifest stores the single-cell keys found under an image root along with
+# the metadata row each cell belongs to, as a plain (uncompressed) .npz file:
+# - cell_keys: all single-cell keys, '\n'-joined into one utf-8 byte array,
+# - rows/counts: run-length encoded metadata row indices of the cells,
+# - root/mtimes/signature: what the manifest was built from. mtimes holds the
+#   mtime of the image root followed by those of all plate directories (in
+#   sorted order, -1 if missing), taken before scanning. The manifest is stale
+#   as soon as any of these mtimes or the metadata rows/patterns change, e.g.
+#   when cells are added to or removed from an existing plate directory.
+
+
+def metadata_signature(plate_names, file_names, patterns):
+    digest = hashlib.sha1()
+    for plate, file_name in zip(plate_names, file_names):
+        digest.update('{0}/{1}\n'.format(plate, file_name).encode())
+    for pattern in patterns or []:
+        digest.update(getattr(pattern, 'pattern', pattern).encode())
+    return digest.hexdigest()
+
+
+def directory_mtimes(root_path, plate_names):
+    mtimes = [os.path.getmtime(root_path)]
+    for plate in sorted(set(plate_names)):
+        plate_path = os.path.join(root_path, plate)
+        if os.path.isdir(plate_path):
+            mtimes.append(os.path.getmtime(plate_path))
+        else:
+            mtimes.append(-1)
+    return np.array(mtimes, dtype=np.float64)
+
+
+def manifest_path(directory, root_path):
+    root_hash = hashlib.sha1(root_path.encode()).hexdigest()[:16]
+    return os.path.join(directory, 'manifest-{0}.npz'.format(root_hash))
+
+
+def _list_plate(root_path, plate):
+    # Maps each image name to the single-cell names found for it. We assume
+    # single-cell images are stored with the original image name as prefix and
+    # then '-{digit}' suffixes, where {digit} is the id/number of the cell
+    # within the image.
+    cells = collections.defaultdict(list)
+    plate_path = os.path.join(root_path, plate)
+    if not os.path.isdir(plate_path):
+        return plate, cells
+    for filename in os.listdir(plate_path):
+        name = os.path.splitext(filename)[0]
+        image_name, separator, _ = name.rpartition('-')
+        if separator:
+            cells[image_name].append(name)
+    for names in cells.values():
+        names.sort()
+    return plate, cells
+
+
+def scan_single_cell_names(root_path,
+                           plate_names,
+                           file_names,
+                           patterns,
+                           number_of_workers=16):
+    '''
+    Finds the single-cell images for every metadata row, listing each plate
+    directory once and scanning plates in parallel.
+    '''
+    assert os.path.isabs(root_path)
+    assert os.path.exists(root_path)
+    plates = sorted(set(plate_names))
+    log.info('Scanning %d plate directories under %s', len(plates), root_path)
+    pool = multiprocessing.pool.ThreadPool(number_of_workers)
+    try:
+        listings = dict(
+            pool.starmap(_list_plate, [(root_path, p) for p in plates]))
+    finally:
+        pool.close()
+
+    original_indices = []
+    single_cell_names = []
+    for index, (plate, file_name) in enumerate(zip(plate_names, file_names)):
+        image_path = os.path.join(plate, file_name)
+        if patterns and not any(p.search(image_path) for p in patterns):
+            continue
+        names = listings[plate].get(file_name, [])
+        single_cell_names.extend(os.path.join(plate, n) for n in names)
+        original_indices.extend([index] * len(names))
+
+    return original_indices, single_cell_names
+
+
+def save(path, root_path, signature, mtimes, indices, keys):
+    '''Stores a manifest, with the directory_mtimes() taken before scanning.'''
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) > 0:
+        run_starts = np.flatnonzero(np.diff(indices)) + 1
+        run_starts = np.concatenate([[0], run_starts])
+        rows = indices[run_starts]
+        counts = np.diff(np.append(run_starts, len(indices)))
+    else:
+        rows = counts = np.zeros(0, dtype=np.int64)
+    cell_keys = np.frombuffer('\n'.join(keys).encode(), dtype=np.uint8)
+    # Write to a temporary file first so that a concurrent reader never sees a
+    # half-written manifest.
+    temporary_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as manifest_file:
+        np.savez(
+            manifest_file,
+            version=MANIFEST_VERSION,
+            root=root_path,
+            mtimes=mtimes,
+            signature=signature,
+            rows=rows,
+            counts=counts,
+            cell_keys=cell_keys)
+    os.rename(temporary_path, path)
+
+
+def load(path, root_path, signature, mtimes):
+    '''Returns (indices, keys), or None if the manifest is missing or stale.'''
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as manifest:
+        if int(manifest['version']) != MANIFEST_VERSION or \
+           str(manifest['root']) != root_path or \
+           not np.array_equal(manifest['mtimes'], mtimes) or \
+           str(manifest['signature']) != signature:
+            log.info('Manifest %s is stale', path)
+            return None
+        indices = np.repeat(manifest['rows'], manifest['counts'])
+        cell_keys = manifest['cell_keys'].tobytes().decode()
+    keys = cell_keys.split('\n') if cell_keys else []
+    assert len(keys) == len(indices), (len(keys), len(indices))
+    return indices, keys
+
+
+def get_single_cell_names(root_path,
+                          plate_names,
+                          file_names,
+                          patterns,
+                          directory=DEFAULT_DIRECTORY,
+                          number_of_workers=16):
+    '''Loads the single-cell names from a manifest, building it if needed.'''
+    signature = metadata_signature(plate_names, file_names, patterns)
+    path = manifest_path(directory, root_path)
+    mtimes = directory_mtimes(root_path, plate_names)
+    loaded = load(path, root_path, signature, mtimes)
+    if loaded is not None:
+        log.info('Loaded manifest %s', path)
+        return loaded
+    indices, keys = scan_single_cell_names(root_path, plate_names, file_names,
+                                           patterns, number_of_workers)
+    try:
+        save(path, root_path, signature, mtimes, indices, keys)
+        log.info('Stored manifest for %s at %s', root_path, path)
+    except (IOError, OSError) as error:
+        log.warning('Could not store manifest at %s: %s', path, error)
+    return np.array(indices, dtype=np.int64), keys
@@ -0,0 +1,111 @@
+import collections
+
+import numpy as np
+import tensorflow as tf
+
+from cytogan.extra import logs
+
+log = logs.get_logger(__name__)
+
+# Tensors of the next batch as handed to models built with inputs=..., where
+# images are already in [-1, +1] and labels is None without conditionals.
+Inputs = collections.namedtuple('Inputs', ['images', 'labels', 'batch_size'])
+
+
+def _normalize_luminance(image):
+    # Same as cell_data._normalize_luminance, but for one image in the graph.
+    maxima = tf.reduce_max(image, axis=[0, 1], keep_dims=True)
+    return image / tf.where(maxima > 0, maxima, tf.ones_like(maxima))
+
+
+def _make_decoder(cell_data, image_shape):
+    if cell_data.image_root is not None:
+        extension = cell_data.sync_images.extension
+        assert extension == 'png', 'Can only decode png images in-graph'
+        root = cell_data.image_root + '/'
+
+        def decode(key):
+            path = tf.string_join([root, key, '.', extension])
+            image = tf.image.decode_png(
+                tf.read_file(path), channels=image_shape[-1])
+            image.set_shape(image_shape)
+            return image
+    else:
+        # Shards are memory-mapped, so "decoding" is just a copy.
+        def load_from_shards(key):
+            ok_keys, images = cell_data.images[[key.decode()]]
+            if not ok_keys:
+                raise IOError('Could not load {0}'.format(key))
+            return np.array(images[0])
+
+        def decode(key):
+            image = tf.py_func(load_from_shards, [key], tf.uint8)
+            image.set_shape(image_shape)
+            return image
+
+    return decode
+
+
+def make_dataset(cell_data,
+                 batch_size,
+                 image_shape,
+                 number_of_threads=8,
+                 prefetch_batches=2):
+    '''
+    Streams training batches out of a CellData instance. Keys (and labels)
+    come from the CellData epoch order, images are read and decoded on
+    number_of_threads threads, rescaled to [-1, +1] in the graph and
+    prefetch_batches batches are kept ready ahead of the model.
+
+    The map, batch and prefetch stages pull rows from CellData well ahead of
+    training, so its iterator state does not match the batches trained on.
+    '''
+    with_labels = cell_data.batches_with_labels
+
+    def generate():
+        for row in cell_data.iterate_rows():
+            if with_labels:
+                yield cell_data.keys[row], cell_data.labels[row]
+            else:
+                yield cell_data.keys[row]
+
+    if with_labels:
+        types = (tf.string, tf.float32)
+        shapes = (tf.TensorShape([]), tf.TensorShape(cell_data.label_shape))
+    else:
+        types, shapes = tf.string, tf.TensorShape([])
+    dataset = tf.data.Dataset.from_generator(generate, types, shapes)
+
+    decode = _make_decoder(cell_data, image_shape)
+    normalize = cell_data.normalize_luminance
+
+    def preprocess(key, *labels):
+        image = tf.cast(decode(key), tf.float32) / 255.0
+        if normalize:
+            image = _normalize_luminance(image)
+        # From [0, 1] to [-1, +1], which is what the GANs train on.
+        image = image * 2.0 - 1
+        return (image, ) + labels if labels else image
+
+    dataset = dataset.map(preprocess, num_parallel_calls=number_of_threads)
+    # Images that fail to load are skipped, like in CellData.next_batch. The
+    # generator never ends, so every batch is full.
+    dataset = dataset.apply(tf.contrib.data.ignore_errors())
+    dataset = dataset.batch(batch_size)
+    return dataset.prefetch(prefetch_batches)
+
+
+def make_inputs(cell_data, batch_size, image_shape, **kwargs):
+    '''Returns Inputs for the next batch of a CellData training dataset.'''
+    dataset = make_dataset(cell_data, batch_size, image_shape, **kwargs)
+    log.info('Streaming batches of %d images through tf.data', batch_size)
+    with tf.name_scope('inputs'):
+        next_batch = dataset.make_one_shot_iterator().get_next()
+        if cell_data.batches_with_labels:
+            images, labels = next_batch
+            labels.set_shape([batch_size] + list(cell_data.label_shape))
+        else:
+            images, labels = next_batch, None
+        images.set_shape([batch_size] + list(image_shape))
+
+    return Inputs(images=images, labels=labels, batch_size=batch_size)
@@ -0,0 +1,79 @@
+import abc
+
+import numpy as np
+
+
+class Sampler(abc.ABC):
+    '''
+    Produces a deterministic order of row indices for every epoch, split into
+    disjoint, evenly sized slices (one per rank) for data-parallel training.
+
+    The order depends only on (seed, epoch), so all ranks agree on it without
+    talking to each other, as long as they share the same seed.
+    '''
+
+    def __init__(self, number_of_items, rank=0, world_size=1, seed=0):
+        assert 0 <= rank < world_size, (rank, world_size)
+        assert number_of_items >= world_size, (number_of_items, world_size)
+        self.number_of_items = number_of_items
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+
+    @property
+    def shard_size(self):
+        # Drop the remainder so that all shards have the same size.
+        return self.number_of_items // self.world_size
+
+    def indices(self, epoch):
+        random = np.random.RandomState((self.seed + epoch) % 2**32)
+        order = self._epoch_order(random)
+        order = order[:self.shard_size * self.world_size]
+        return order[self.rank::self.world_size]
+
+    @abc.abstractmethod
+    def _epoch_order(self, random):
+        pass
+
+    def __repr__(self):
+        return '{0}<{1:,} items, rank {2}/{3}>'.format(
+            self.__class__.__name__, self.number_of_items, self.rank,
+            self.world_size)
+
+
+class UniformSampler(Sampler):
+    '''Visits every item exactly once per epoch, in shuffled order.'''
+
+    def _epoch_order(self, random):
+        return random.permutation(self.number_of_items)
+
+
+class StratifiedSampler(Sampler):
+    '''
+    Draws (with replacement) class-balanced epochs: every draw first picks one
+    of the strata uniformly at random, then one of its items. Items are stored
+    grouped by stratum, so each draw costs two random numbers and a lookup.
+    '''
+
+    def __init__(self, strata, rank=0, world_size=1, seed=0):
+        super(StratifiedSampler, self).__init__(
+            len(strata), rank, world_size, seed)
+        strata = np.asarray(strata)
+        # The items of the i-th stratum are items[starts[i]:starts[i] + sizes[i]]
+        self.items = np.argsort(strata, kind='mergesort')
+        _, self.sizes = np.unique(strata, return_counts=True)
+        self.starts = np.cumsum(self.sizes) - self.sizes
+
+    @property
+    def number_of_strata(self):
+        return len(self.sizes)
+
+    def _epoch_order(self, random):
+        strata = random.randint(self.number_of_strata,
+                                size=self.number_of_items)
+        offsets = random.random_sample(self.number_of_items)
+        offsets = (offsets * self.sizes[strata]).astype(np.int64)
+        return self.items[self.starts[strata] + offsets]
+
+
+SAMPLERS = ('uniform', 'stratified')
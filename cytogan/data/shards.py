@@ -0,0 +1,199 @@
+import json
+import os.path
+
+import numpy as np
+import pandas as pd
+
+from cytogan.extra import logs
+
+log = logs.get_logger(__name__)
+
+# A shard directory looks like this:
+# - shape.json: the (height, width, channels) shape of every cell,
+# - index.csv: one row per cell with its key, shard file name and offset (in
+#   units of cells) into that shard, optionally followed by more columns,
+# - *.bin: raw, contiguous uint8 cell arrays that we memory-map on load.
+SHAPE_FILE = 'shape.json'
+INDEX_FILE = 'index.csv'
+INDEX_COLUMNS = ['key', 'shard', 'offset']
+
+
+def read_image_shape(directory):
+    with open(os.path.join(directory, SHAPE_FILE)) as shape_file:
+        return tuple(json.load(shape_file))
+
+
+def write_image_shape(directory, image_shape):
+    '''Creates the shard directory, or checks that its shape matches.'''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    shape_path = os.path.join(directory, SHAPE_FILE)
+    if os.path.exists(shape_path):
+        existing_shape = read_image_shape(directory)
+        assert existing_shape == tuple(image_shape), existing_shape
+    else:
+        with open(shape_path, 'w') as shape_file:
+            json.dump(list(image_shape), shape_file)
+
+
+def open_index(directory, columns=INDEX_COLUMNS):
+    '''Opens the index for appending, writing the header if it is new.'''
+    assert list(columns[:len(INDEX_COLUMNS)]) == INDEX_COLUMNS, columns
+    index_path = os.path.join(directory, INDEX_FILE)
+    write_header = not os.path.exists(index_path)
+    index_file = open(index_path, 'a')
+    if write_header:
+        index_file.write(','.join(columns) + '\n')
+    return index_file
+
+
+def read_index(directory):
+    index_path = os.path.join(directory, INDEX_FILE)
+    index = pd.read_csv(index_path, dtype=dict(key=str, shard=str))
+    # A cell written again (e.g. by a resumed segmentation run) supersedes
+    # the earlier rows with its key.
+    duplicates = index.duplicated('key', keep='last')
+    if duplicates.any():
+        log.warning('Ignoring %d superseded rows in %s', duplicates.sum(),
+                    index_path)
+        index = index[~duplicates.values]
+    index.set_index('key', inplace=True)
+    return index
+
+
+class ShardWriter(object):
+    '''
+    Appends uint8 cell images to packed shard files. Without write_index, the
+    caller is responsible for adding the (key, shard, offset) rows that
+    append() returns to the index, e.g. when several processes write shards
+    into the same directory (with different prefixes).
+    '''
+
+    def __init__(self,
+                 directory,
+                 image_shape,
+                 cells_per_shard=100000,
+                 prefix='shard',
+                 write_index=True):
+        self.directory = directory
+        self.image_shape = tuple(image_shape)
+        self.cells_per_shard = cells_per_shard
+        self.prefix = prefix
+        self.shard_number = 0
+        self.shard_file = None
+        self.shard_name = None
+        self.cells_in_shard = 0
+
+        write_image_shape(directory, self.image_shape)
+        self.index_file = open_index(directory) if write_index else None
+
+    def append(self, key, image):
+        assert image.shape == self.image_shape, (key, image.shape)
+        if self.shard_file is None or \
+           self.cells_in_shard == self.cells_per_shard:
+            self._next_shard()
+        self.shard_file.write(np.ascontiguousarray(image, np.uint8).tobytes())
+        row = key, self.shard_name, self.cells_in_shard
+        if self.index_file is not None:
+            self.index_file.write('{0},{1},{2}\n'.format(*row))
+        self.cells_in_shard += 1
+        return row
+
+    def flush(self):
+        if self.shard_file is not None:
+            self.shard_file.flush()
+        if self.index_file is not None:
+            self.index_file.flush()
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+        if self.index_file is not None:
+            self.index_file.close()
+
+    def _next_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        # Never overwrite shards from earlier runs into the same directory.
+        while True:
+            self.shard_name = '{0}-{1:05d}.bin'.format(self.prefix,
+                                                       self.shard_number)
+            self.shard_number += 1
+            path = os.path.join(self.directory, self.shard_name)
+            if not os.path.exists(path):
+                break
+        self.shard_file = open(path, 'wb')
+        self.cells_in_shard = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ShardImageLoader(object):
+    '''Loads cell images out of memory-mapped shards.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.image_shape = read_image_shape(directory)
+        self.index = read_index(directory)
+        self.shards = {}
+        for shard_name in self.index['shard'].unique():
+            path = os.path.join(directory, shard_name)
+            self.shards[shard_name] = self._map_shard(path)
+        self._drop_rows_past_shard_ends()
+        log.info('Memory-mapped {0:,} cells from {1} shards in {2}'.format(
+            len(self.index), len(self.shards), directory))
+
+    @property
+    def keys(self):
+        return self.index.index
+
+    def __getitem__(self, image_keys):
+        image_keys = list(image_keys)
+        positions = self.index.index.get_indexer(image_keys)
+        shard_names = self.index['shard'].values
+        offsets = self.index['offset'].values
+        ok_keys, ok_images = [], []
+        for key, position in zip(image_keys, positions):
+            if position == -1:
+                log.error('Could not find {0} in shards'.format(key))
+                continue
+            shard = self.shards[shard_names[position]]
+            image = shard[offsets[position]]
+            ok_keys.append(key)
+            ok_images.append(image)
+
+        return ok_keys, ok_images
+
+    def fetch_async(self, image_keys):
+        # Shards are memory-mapped, so the OS page cache does the prefetching.
+        pass
+
+    def _map_shard(self, path):
+        # A writer that crashed can leave a partial cell at the end of its
+        # shard, so we only map the whole cells.
+        cell_bytes = int(np.prod(self.image_shape))
+        shard_bytes = os.path.getsize(path)
+        number_of_cells = shard_bytes // cell_bytes
+        if shard_bytes % cell_bytes != 0:
+            log.warning('Ignoring a truncated cell at the end of %s', path)
+        if number_of_cells == 0:
+            return np.zeros((0, ) + self.image_shape, dtype=np.uint8)
+        return np.memmap(
+            path,
+            dtype=np.uint8,
+            mode='r',
+            shape=(number_of_cells, ) + self.image_shape)
+
+    def _drop_rows_past_shard_ends(self):
+        lengths = self.index['shard'].map(
+            {name: len(shard) for name, shard in self.shards.items()})
+        past_end = (self.index['offset'] >= lengths).values
+        if past_end.any():
+            log.warning('Ignoring %d index rows past the end of their shard',
+                        past_end.sum())
+            self.index = self.index[~past_end]
@@ -1,4 +1,27 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import time
+
+# Maps the QueueHandlers we install to the handlers their listener feeds.
+_queue_targets = {}
+
+
+def _log_through_queue(logger, handlers):
+    '''
+    Attaches handlers to logger behind a queue, so that formatting and writing
+    records happens on a listener thread instead of the logging thread.
+    '''
+    record_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(record_queue)
+    listener = logging.handlers.QueueListener(
+        record_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Flushes whatever is still queued when the process exits.
+    atexit.register(listener.stop)
+    _queue_targets[queue_handler] = handlers
+    logger.addHandler(queue_handler)
 
 
 def get_root_logger(filename=None):
@@ -12,28 +35,65 @@ def get_root_logger(filename=None):
         '%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d] %(message)s')
     for handler in handlers:
         handler.setFormatter(formatter)
-        logger.addHandler(handler)
+    _log_through_queue(logger, handlers)
 
     return logger
 
 
-def get_raw_logger(name):
+class ThrottledFileHandler(logging.FileHandler):
+    '''
+    FileHandler that drops records arriving less than min_interval seconds
+    after the last one it wrote, except for the last one before a line ends.
+    '''
+
+    def __init__(self, filename, min_interval):
+        super(ThrottledFileHandler, self).__init__(filename)
+        self.min_interval = min_interval
+        self.last_write = 0
+        self.dropped_record = None
+
+    def emit(self, record):
+        now = time.time()
+        line_ends = '\n' in record.getMessage()
+        if now - self.last_write < self.min_interval and not line_ends:
+            self.dropped_record = record
+            return
+        if line_ends and self.dropped_record is not None:
+            super(ThrottledFileHandler, self).emit(self.dropped_record)
+        self.dropped_record = None
+        self.last_write = now
+        super(ThrottledFileHandler, self).emit(record)
+
+
+def get_raw_logger(name, file_min_interval=None):
     '''
     Returns a logger with the same handlers as the root logger but no
-    formatting at all.
+    formatting at all. With a file_min_interval (in seconds), its files are
+    written no more often than that, while the console still sees every
+    record.
     '''
     logger = logging.getLogger('{0}-raw'.format(name))
     logger.setLevel(logger.parent.level)
     logger.propagate = False
-    formatter = logging.Formatter('%(message)s')
+    parent_handlers = []
     for parent_handler in logger.parent.handlers:
+        parent_handlers.extend(
+            _queue_targets.get(parent_handler, [parent_handler]))
+    formatter = logging.Formatter('%(message)s')
+    handlers = []
+    for parent_handler in parent_handlers:
         if isinstance(parent_handler, logging.FileHandler):
-            handler = logging.FileHandler(parent_handler.baseFilename)
+            if file_min_interval is None:
+                handler = logging.FileHandler(parent_handler.baseFilename)
+            else:
+                handler = ThrottledFileHandler(parent_handler.baseFilename,
+                                               file_min_interval)
         else:
             handler = logging.StreamHandler()
         handler.setFormatter(formatter)
         handler.terminator = ''
-        logger.addHandler(handler)
+        handlers.append(handler)
+    _log_through_queue(logger, handlers)
 
     return logger
 
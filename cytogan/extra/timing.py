@@ -0,0 +1,51 @@
+import collections
+import contextlib
+import time
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+class StepTimer(object):
+    '''
+    Collects the wall time spent in named phases of each training step. Time
+    spent in a phase more than once per step is added up. end_step() closes a
+    step and end_epoch() rolls up all steps of the epoch into percentiles.
+    '''
+
+    def __init__(self):
+        self.step_times = collections.defaultdict(float)
+        self.epoch_times = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.step_times[name] += time.time() - start
+
+    def end_step(self):
+        for name, seconds in self.step_times.items():
+            self.epoch_times[name].append(seconds)
+        self.step_times.clear()
+
+    def end_epoch(self):
+        '''
+        Returns {phase: {'p50': ..., 'p95': ..., 'p99': ..., 'total': ...,
+        'steps': ...}} in seconds over all steps in which the phase occurred,
+        and starts a new epoch.
+        '''
+        rollup = {}
+        for name, times in self.epoch_times.items():
+            percentiles = np.percentile(times, PERCENTILES)
+            stats = {
+                'p{0}'.format(p): float(v)
+                for p, v in zip(PERCENTILES, percentiles)
+            }
+            stats['total'] = float(np.sum(times))
+            stats['steps'] = len(times)
+            rollup[name] = stats
+        self.epoch_times.clear()
+        return rollup
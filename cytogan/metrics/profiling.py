@@ -1,5 +1,7 @@
+import json
 import re
 
+import h5py
 import numpy as np
 import pandas as pd
 import scipy.linalg
@@ -9,8 +11,86 @@ from cytogan.extra import logs
 
 log = logs.get_logger(__name__)
 
+# An HDF5 profile file holds a dense float32 matrix of profiles, the index of
+# the dataset and every other (metadata) column as a dataset of its own.
+PROFILE_FORMATS = ('h5', 'csv')
+H5_PROFILES = 'profiles'
+H5_INDEX = 'index'
+H5_COLUMNS = 'columns'
+
+
+def _is_h5(path):
+    return path.endswith(('.h5', '.hdf5'))
+
+
+def _write_column(group, name, values):
+    values = np.asarray(values)
+    if values.dtype.kind in 'OSU':
+        values = np.array([str(value) for value in values], dtype=object)
+        group.create_dataset(
+            name, data=values, dtype=h5py.special_dtype(vlen=str))
+    else:
+        group.create_dataset(name, data=values)
+
+
+def _read_column(dataset):
+    values = dataset[()]
+    if values.dtype == object or values.dtype.kind == 'S':
+        # Depending on the h5py version, strings come back as bytes.
+        values = np.array(
+            [v.decode() if isinstance(v, bytes) else v for v in values],
+            dtype=object)
+    return values
+
+
+def _memory_map(path, dataset):
+    offset = dataset.id.get_offset()
+    if offset is None:
+        # Not stored contiguously (or empty), so we can't map it.
+        return dataset[()]
+    return np.memmap(
+        path, dtype=dataset.dtype, mode='r', shape=dataset.shape, offset=offset)
+
+
+def _save_h5_profiles(path, profiles):
+    matrix = np.array(list(profiles['profile']), dtype=np.float32)
+    columns = [column for column in profiles.columns if column != 'profile']
+    with h5py.File(path, 'w') as profile_file:
+        # Uncompressed, so that loading can memory-map the matrix.
+        profile_file.create_dataset(H5_PROFILES, data=matrix)
+        _write_column(profile_file, H5_INDEX, profiles.index.values)
+        if profiles.index.name is not None:
+            profile_file[H5_INDEX].attrs['name'] = profiles.index.name
+        group = profile_file.create_group(H5_COLUMNS)
+        for column in columns:
+            _write_column(group, column, profiles[column].values)
+        group.attrs['order'] = json.dumps(columns)
+
+
+def _load_h5_profiles(path):
+    with h5py.File(path, 'r') as profile_file:
+        group = profile_file[H5_COLUMNS]
+        columns = json.loads(group.attrs['order'])
+        index = pd.Index(
+            _read_column(profile_file[H5_INDEX]),
+            name=profile_file[H5_INDEX].attrs.get('name'))
+        data = pd.DataFrame(
+            {column: _read_column(group[column])
+             for column in columns},
+            index=index,
+            columns=columns)
+        matrix = _memory_map(path, profile_file[H5_PROFILES])
+    # Rows of the memory-mapped matrix.
+    data['profile'] = list(matrix)
+
+    return data
+
 
 def save_profiles(path, profiles):
+    '''Saves profiles as HDF5 if path ends in .h5, else as gzipped CSV.'''
+    if _is_h5(path):
+        _save_h5_profiles(path, profiles)
+        return
     profiles.to_csv(
         path,
         header=True,
@@ -20,7 +100,13 @@ def save_profiles(path, profiles):
 
 
 def load_profiles(path, index=None):
+    '''
+    Loads profiles saved by save_profiles(). HDF5 files store their own
+    index, so index only applies to CSV files.
+    '''
     log.info('Loading profiles from %s', path)
+    if _is_h5(path):
+        return _load_h5_profiles(path)
     data = pd.read_csv(path, index_col=index)
     parsed_profiles = []
     for p in data['profile']:
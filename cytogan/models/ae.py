@@ -45,14 +45,13 @@ class AE(model.Model):
         self.encoder = Model(self.original_images, self.latent)
 
     def train_on_batch(self, batch, with_summary=False):
-        fetches = [self.optimization, self.loss]
-        if with_summary is not None:
-            fetches.append(self.summary)
-        outputs = self.session.run(
-            fetches, feed_dict={self.original_images: batch})
+        fetches = [self.optimization, self.metrics, self.loss]
         if with_summary:
-            return outputs[1:]
-        return outputs[1]
+            fetches.append(self.summary)
+        with self.timer.phase('update'):
+            outputs = self.session.run(
+                fetches, feed_dict={self.original_images: batch})
+        return self._make_step_metrics(outputs[2], outputs[1], outputs[3:])
 
     def encode(self, images):
         return self.encoder.predict_on_batch(np.array(images))
@@ -74,6 +73,9 @@ class AE(model.Model):
         optimizer = tf.train.AdamOptimizer(self.learning_rate)
         self.optimization = optimizer.minimize(loss, self.global_step)
 
+    def _get_global_step_update(self):
+        return self.optimization
+
     def __repr__(self):
         lines = [self.name]
         try:
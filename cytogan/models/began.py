@@ -4,7 +4,7 @@ import keras.backend as K
 import numpy as np
 import tensorflow as tf
 from keras.layers import (Activation, Concatenate, Conv2D, Dense, Flatten,
-                          Input, Reshape)
+                          Reshape)
 from keras.models import Model
 
 from cytogan.extra.layers import AddNoise, RandomNormal, UpSamplingNN
@@ -31,26 +31,25 @@ Hyper = collections.namedtuple('Hyper', [
 
 
 class BEGAN(gan.GAN):
-    def __init__(self, hyper, learning, session):
+    def __init__(self, hyper, learning, session, inputs=None):
         self.k = None
         self.reconstructions = None
-        super(BEGAN, self).__init__(hyper, learning, session)
+        super(BEGAN, self).__init__(hyper, learning, session, inputs)
 
     def _define_graph(self):
         if self.is_conditional:
-            self.conditional = gan.get_conditional_inputs(
-                ('G', 'D'), self.conditional_shape)
+            self.conditional = self._define_conditional_inputs()
             if self.conditional_embedding is not None:
                 self.conditional_embedding_layer = Dense(
                     self.conditional_embedding, activation='relu')
 
         with K.name_scope('G'):
-            self.batch_size = Input(batch_shape=[1], name='batch_size')
+            self.batch_size = self._define_batch_size()
             self.noise = RandomNormal(self.noise_size)(self.batch_size)
             conditional = self._get_conditional_embedding('G')
             self.fake_images = self._define_generator(self.noise, conditional)
 
-        self.images = Input(shape=self.image_shape, name='images')
+        self.images = self._define_discriminator_images()
 
         with K.name_scope('E'):
             self.latent = self._define_encoder(self.images)
@@ -75,33 +74,19 @@ class BEGAN(gan.GAN):
             D=self._define_discriminator_loss(self.reconstructions),
             G=self._define_generator_loss(self.gan.outputs[0]))
 
-    def _train_discriminator(self, fake_images, real_images, conditional,
-                             with_summary):
-        images = np.concatenate([fake_images, real_images], axis=0)
-        fetches = [self.update_k, self.optimizer['D'], self.loss['D']]
-        if with_summary:
-            fetches.append(self.summaries['D'])
-
-        feed_dict = {self.batch_size: [len(fake_images)], self.images: images}
-        if self.is_conditional:
-            # Not sure why we need to feed the generator conditional, but TF
-            # complains otherwise (same with batch_size above).
-            feed_dict[self.conditional['G']] = np.zeros_like(conditional)
-            # Duplicate the conditional (for the real and for the fake images).
-            conditional = np.concatenate([conditional, conditional], axis=0)
-            feed_dict[self.conditional['D']] = conditional
-
-        return self.session.run(fetches, feed_dict)[2:]
+    def _get_discriminator_updates(self):
+        return [self.update_k, self.optimizer['D']]
 
     def _train_generator(self, batch_size, conditional, with_summary):
-        fetches = [self.optimizer['G'], self.loss['G']]
+        fetches = [self.optimizer['G'], self.metrics, self.loss['G']]
         if with_summary:
             fetches.append(self.summaries['G'])
 
         feed_dict = {self.batch_size: [batch_size]}
         if self.is_conditional:
             feed_dict[self.conditional['G']] = conditional
-        return self.session.run(fetches, feed_dict=feed_dict)[1:]
+        results = self.session.run(fetches, feed_dict=feed_dict)
+        return results[2:], results[1]
 
     def _define_generator(self, noise, conditional=None):
         if conditional is None:
@@ -28,9 +28,9 @@ Hyper = collections.namedtuple('Hyper', [
 
 
 class BiGAN(gan.GAN):
-    def __init__(self, hyper, learning, session):
+    def __init__(self, hyper, learning, session, inputs=None):
         self.noise_size = hyper.latent_size
-        super(BiGAN, self).__init__(hyper, learning, session)
+        super(BiGAN, self).__init__(hyper, learning, session, inputs)
         if self.noise_kind == 'normal':
             self.noise_distribution = np.random.normal
         else:
@@ -66,18 +66,33 @@ class BiGAN(gan.GAN):
             self.fake_images = self._define_generator(self.noise)
 
         with K.name_scope('E'):
-            self.images_to_encode = Input(
-                shape=self.image_shape, name='real_images')
+            if self.inputs is None:
+                self.images_to_encode = Input(
+                    shape=self.image_shape, name='real_images')
+            else:
+                self.images_to_encode = gan.input_with_default(
+                    self.inputs.images, 'real_images')
             self.latent = self._define_encoder(self.images_to_encode)
 
         with K.name_scope('D'):
-            self.images = Input(shape=self.image_shape, name='images')
-            self.input_code = Input(
-                shape=[self.latent_size], name='representations')
+            if self.inputs is None:
+                self.images = Input(shape=self.image_shape, name='images')
+                self.input_code = Input(
+                    shape=[self.latent_size], name='representations')
+            else:
+                # (G(z), z) pairs first, then (x, E(x)) for the real images.
+                images = tf.concat([
+                    tf.stop_gradient(self.fake_images), self.images_to_encode
+                ], axis=0)
+                code = tf.concat(
+                    [self.noise, tf.stop_gradient(self.latent)], axis=0)
+                self.images = gan.input_with_default(images, 'images')
+                self.input_code = gan.input_with_default(
+                    code, 'representations')
             self.probability = self._define_discriminator(
                 self.images, self.input_code)
 
-        self.labels = Input(batch_shape=[None], name='labels')
+        self.labels = self._define_discriminator_labels()
 
         self.generator = Model(self.noise, self.fake_images, name='G')
         self.encoder = Model(self.images_to_encode, self.latent, name='E')
@@ -169,23 +184,57 @@ class BiGAN(gan.GAN):
             return losses.binary_crossentropy(labels, probability)
 
     def train_on_batch(self, batch, with_summary=False):
+        if self.inputs is not None:
+            return self._train_on_inputs(with_summary)
         real_images = (np.array(batch) * 2.0) - 1
 
         noise = self._sample_noise(len(real_images))
-        fake_images = self.generate(noise, rescale=False)
-        real_code = self.encode(real_images, rescale=False)
+        with self.timer.phase('generate'):
+            fake_images = self.generate(noise, rescale=False)
+            real_code = self.encode(real_images, rescale=False)
 
-        d_tensors = self._train_discriminator(fake_images, real_images, noise,
-                                              real_code, with_summary)
+        with self.timer.phase('update_D'):
+            d_tensors = self._train_discriminator(
+                fake_images, real_images, noise, real_code, with_summary)
 
         noise = self._sample_noise(len(real_images))
-        g_tensors = self._train_generator(noise, with_summary)
+        with self.timer.phase('update_G'):
+            g_tensors, metrics = self._train_generator(noise, with_summary)
 
-        e_tensors = self._train_encoder(real_images, with_summary)
+        with self.timer.phase('update_E'):
+            e_tensors = self._train_encoder(real_images, with_summary)
 
         losses = dict(D=d_tensors[0], G=g_tensors[0], E=e_tensors[0])
         tensors = dict(G=g_tensors, D=d_tensors, E=e_tensors)
-        return self._maybe_with_summary(losses, tensors, with_summary)
+        return self._get_step_metrics(losses, tensors, metrics)
+
+    def _train_on_inputs(self, with_summary):
+        # The discriminator step generates and encodes in the same run. The
+        # encoder step then pulls its own batch from the input pipeline.
+        batch_size = self.inputs.batch_size
+        fetches = [self.optimizer['D'], self.loss['D']]
+        if with_summary:
+            fetches.append(self.summaries['D'])
+        with self.timer.phase('update_D'):
+            d_tensors = self.session.run(fetches, {
+                self.noise: self._sample_noise(batch_size),
+                K.learning_phase(): 1,
+            })[1:]
+
+        noise = self._sample_noise(batch_size)
+        with self.timer.phase('update_G'):
+            g_tensors, metrics = self._train_generator(noise, with_summary)
+
+        fetches = [self.optimizer['E'], self.loss['E']]
+        if with_summary:
+            fetches.append(self.summaries['E'])
+        with self.timer.phase('update_E'):
+            e_tensors = self.session.run(fetches,
+                                         {K.learning_phase(): 1})[1:]
+
+        losses = dict(D=d_tensors[0], G=g_tensors[0], E=e_tensors[0])
+        tensors = dict(G=g_tensors, D=d_tensors, E=e_tensors)
+        return self._get_step_metrics(losses, tensors, metrics)
 
     def _train_discriminator(self, fake_images, real_images, fake_code,
                              real_code, with_summary):
@@ -207,7 +256,7 @@ class BiGAN(gan.GAN):
         return outputs[1:]
 
     def _train_generator(self, noise, with_summary):
-        fetches = [self.optimizer['G'], self.loss['G']]
+        fetches = [self.optimizer['G'], self.metrics, self.loss['G']]
         if with_summary:
             fetches.append(self.summaries['G'])
 
@@ -216,7 +265,7 @@ class BiGAN(gan.GAN):
             K.learning_phase(): 1,
         })
 
-        return outputs[1:]
+        return outputs[2:], outputs[1]
 
     def _train_encoder(self, images, with_summary):
         fetches = [self.optimizer['E'], self.loss['E']]
@@ -4,7 +4,7 @@ import keras.backend as K
 import numpy as np
 import tensorflow as tf
 from keras.layers import (Activation, Concatenate, Conv2D, Dense, Flatten,
-                          Input, LeakyReLU, Reshape, UpSampling2D)
+                          LeakyReLU, Reshape, UpSampling2D)
 from keras.models import Model
 
 from cytogan.extra.layers import (AddNoise, BatchNorm, RandomNormal,
@@ -28,41 +28,15 @@ Hyper = collections.namedtuple('Hyper', [
 
 
 class DCGAN(gan.GAN):
-    def __init__(self, hyper, learning, session):
+    def __init__(self, hyper, learning, session, inputs=None):
         self.batch_size = None
         self.labels = None  # 0/1
         self.d_final = None  # D(x)
 
-        super(DCGAN, self).__init__(hyper, learning, session)
-
-    def _train_discriminator(self, fake_images, real_images, conditional,
-                             with_summary):
-        labels = np.concatenate(
-            [np.zeros(len(fake_images)),
-             np.ones(len(real_images))], axis=0)
-        images = np.concatenate([fake_images, real_images], axis=0)
-        fetches = [self.optimizer['D'], self.loss['D']]
-        if with_summary and self.summaries['D'] is not None:
-            fetches.append(self.summaries['D'])
-
-        feed_dict = {
-            self.batch_size: [len(fake_images)],
-            self.images: images,
-            self.labels: labels,
-            K.learning_phase(): 1,
-        }
-        if self.is_conditional:
-            # Not sure why we need to feed the generator conditional, but TF
-            # complains otherwise.
-            feed_dict[self.conditional['G']] = np.zeros_like(conditional)
-            # Duplicate the conditional (for the real and for the fake images).
-            conditional = np.concatenate([conditional, conditional], axis=0)
-            feed_dict[self.conditional['D']] = conditional
-
-        return self.session.run(fetches, feed_dict)[1:]
+        super(DCGAN, self).__init__(hyper, learning, session, inputs)
 
     def _train_generator(self, batch_size, conditional, with_summary):
-        fetches = [self.optimizer['G'], self.loss['G']]
+        fetches = [self.optimizer['G'], self.metrics, self.loss['G']]
         if with_summary and self.summaries['G'] is not None:
             fetches.append(self.summaries['G'])
 
@@ -70,14 +44,15 @@ class DCGAN(gan.GAN):
         if self.is_conditional:
             feed_dict[self.conditional['G']] = conditional
 
-        return self.session.run(fetches, feed_dict)[1:]
+        results = self.session.run(fetches, feed_dict)
+        return results[2:], results[1]
 
     def _define_graph(self):
         if self.is_conditional:
             self._define_conditional_units(self.conditional_shape)
 
         with K.name_scope('G'):
-            self.batch_size = Input(batch_shape=[1], name='batch_size')
+            self.batch_size = self._define_batch_size()
             if self.noise_kind == 'normal':
                 self.noise = RandomNormal(self.noise_size)(self.batch_size)
             else:
@@ -86,7 +61,7 @@ class DCGAN(gan.GAN):
             self.fake_images = self._define_generator(self.noise, conditional)
 
         with K.name_scope('D'):
-            self.images = Input(shape=self.image_shape, name='images')
+            self.images = self._define_discriminator_images()
             logits = self._define_discriminator(self.images)
             self.latent = Dense(self.latent_size, name='latent')(logits)
             if self.is_conditional:
@@ -96,7 +71,7 @@ class DCGAN(gan.GAN):
                 final_input = self.latent
             self.d_final = self._define_final_discriminator_layer(final_input)
 
-        self.labels = Input(batch_shape=[None], name='labels')
+        self.labels = self._define_discriminator_labels()
 
         parameters = self._get_model_parameters(self.is_conditional)
         generator_inputs, discriminator_inputs, generator_outputs = parameters
@@ -151,8 +126,7 @@ class DCGAN(gan.GAN):
         return D
 
     def _define_conditional_units(self, conditional_shape):
-        self.conditional = gan.get_conditional_inputs(
-            ('G', 'D'), conditional_shape)
+        self.conditional = self._define_conditional_inputs()
         if self.conditional_embedding is not None:
             self.conditional_embedding_layer = Dense(
                 self.conditional_embedding,
@@ -6,15 +6,11 @@ from keras.layers import Input
 from cytogan.models import model, util
 
 
-def get_conditional_inputs(scopes, conditional_shape):
-    if conditional_shape is None:
-        return {scope: None for scope in scopes}
-    inputs = {}
-    for scope in scopes:
-        name = '{0}/conditional'.format(scope)
-        inputs[scope] = Input(shape=conditional_shape, name=name)
-
-    return inputs
+def input_with_default(default, name):
+    # A Keras input that evaluates default unless something is fed into it.
+    shape = [None] + default.shape.as_list()[1:]
+    tensor = tf.placeholder_with_default(default, shape, name=name)
+    return Input(batch_shape=shape, tensor=tensor, name=name)
 
 
 def smooth_labels(labels, low=0.8, high=1.0):
@@ -23,7 +19,11 @@ def smooth_labels(labels, low=0.8, high=1.0):
 
 
 class GAN(model.Model):
-    def __init__(self, hyper, learning, session):
+    def __init__(self, hyper, learning, session, inputs=None):
+        # Tensors from an input pipeline (see cytogan.data.pipeline), which
+        # replace the real images and conditionals we'd otherwise feed.
+        self.inputs = inputs
+        self.real_images = None
         self.images = None  # x
         self.conditional = None
         self.conditional_embedding = None
@@ -51,7 +51,6 @@ class GAN(model.Model):
         super(GAN, self).__init__(learning, session)
 
         self.summaries = self._get_summary_nodes()
-        self.combined_summary = tf.summary.merge(list(self.summaries.values()))
 
     @property
     def name(self):
@@ -80,9 +79,12 @@ class GAN(model.Model):
         images, conditionals = self._expand_batch(batch)
         if rescale:
             images = (np.array(images) * 2.0) - 1
-        if conditionals is None:
-            return self.encoder.predict_on_batch(images)
-        return self.encoder.predict_on_batch([images, conditionals])
+        # Keras won't predict on models whose inputs are backed by tensors
+        # (as with an input pipeline), so we feed the inputs ourselves.
+        feed_dict = {self.encoder.inputs[0]: images, K.learning_phase(): 0}
+        if conditionals is not None:
+            feed_dict[self.encoder.inputs[1]] = conditionals
+        return self.session.run(self.encoder.outputs[0], feed_dict)
 
     def generate(self, latent_samples, conditionals=None, rescale=True):
         feed_dict = {K.learning_phase(): 0}
@@ -98,19 +100,108 @@ class GAN(model.Model):
         return (images + 1) / 2.0 if rescale else images
 
     def train_on_batch(self, batch, with_summary=False):
+        if self.inputs is not None:
+            return self._train_on_inputs(with_summary)
         real_images, conditionals = self._expand_batch(batch)
         real_images = (real_images * 2.0) - 1
         batch_size = len(real_images)
-        fake_images = self.generate(batch_size, conditionals, rescale=False)
 
-        d_tensors = self._train_discriminator(fake_images, real_images,
-                                              conditionals, with_summary)
-        g_tensors = self._train_generator(batch_size, conditionals,
-                                          with_summary)
+        # The fakes are generated (and concatenated with the real images) in
+        # the same run as the discriminator update.
+        feed_dict = {
+            self.batch_size: [batch_size],
+            self.real_images: real_images,
+        }
+        if self.is_conditional:
+            feed_dict[self.conditional['G']] = conditionals
+        with self.timer.phase('update_D'):
+            d_tensors, _ = self._train_discriminator_fused(
+                feed_dict, [], with_summary)
+        with self.timer.phase('update_G'):
+            g_tensors, metrics = self._train_generator(
+                batch_size, conditionals, with_summary)
+
+        losses = dict(D=d_tensors[0], G=g_tensors[0])
+        tensors = dict(D=d_tensors, G=g_tensors)
+        return self._get_step_metrics(losses, tensors, metrics)
+
+    def _train_on_inputs(self, with_summary):
+        # Same as train_on_batch, but the real images and conditionals come
+        # from the input pipeline. We need the conditionals of this batch for
+        # the generator step, though.
+        extra_fetches = [self.conditional['G']] if self.is_conditional else []
+        with self.timer.phase('update_D'):
+            d_tensors, extra_values = self._train_discriminator_fused(
+                {}, extra_fetches, with_summary)
+        conditionals = extra_values[0] if self.is_conditional else None
+        with self.timer.phase('update_G'):
+            g_tensors, metrics = self._train_generator(
+                self.inputs.batch_size, conditionals, with_summary)
 
         losses = dict(D=d_tensors[0], G=g_tensors[0])
         tensors = dict(D=d_tensors, G=g_tensors)
-        return self._maybe_with_summary(losses, tensors, with_summary)
+        return self._get_step_metrics(losses, tensors, metrics)
+
+    def _train_discriminator_fused(self, feed_dict, extra_fetches,
+                                   with_summary):
+        # Returns the [loss, summary] tensors and values of extra_fetches.
+        updates = self._get_discriminator_updates()
+        fetches = updates + extra_fetches + [self.loss['D']]
+        if with_summary and self.summaries['D'] is not None:
+            fetches.append(self.summaries['D'])
+
+        feed_dict[K.learning_phase()] = 1
+        results = self.session.run(fetches, feed_dict)[len(updates):]
+        return results[len(extra_fetches):], results[:len(extra_fetches)]
+
+    def _get_discriminator_updates(self):
+        return [self.optimizer['D']]
+
+    def _define_batch_size(self):
+        if self.inputs is None:
+            return Input(batch_shape=[1], name='batch_size')
+        default = tf.constant([self.inputs.batch_size], dtype=tf.float32)
+        tensor = tf.placeholder_with_default(default, [1], name='batch_size')
+        return Input(batch_shape=[1], tensor=tensor, name='batch_size')
+
+    def _define_discriminator_images(self):
+        # Unless fed directly, the discriminator sees the fakes generated in
+        # the same run, followed by the real images (fed or from the pipeline).
+        if self.inputs is None:
+            self.real_images = tf.placeholder(
+                tf.float32, [None] + self.image_shape, name='real_images')
+            real_images = self.real_images
+        else:
+            real_images = self.inputs.images
+        fake_images = tf.stop_gradient(self.fake_images)
+        images = tf.concat([fake_images, real_images], axis=0)
+        return input_with_default(images, 'images')
+
+    def _define_discriminator_labels(self):
+        # Zeros for the fake images, then ones for the real images.
+        if self.inputs is not None:
+            batch_size = self.inputs.batch_size
+        elif self.batch_size is not None:
+            batch_size = tf.cast(tf.squeeze(self.batch_size), tf.int32)
+        else:
+            return Input(batch_shape=[None], name='labels')
+        labels = tf.concat([tf.zeros([batch_size]), tf.ones([batch_size])], 0)
+        tensor = tf.placeholder_with_default(labels, [None], name='labels')
+        return Input(batch_shape=[None], tensor=tensor, name='labels')
+
+    def _define_conditional_inputs(self):
+        conditional = {}
+        if self.inputs is None:
+            conditional['G'] = Input(
+                shape=self.conditional_shape, name='G/conditional')
+        else:
+            assert self.inputs.labels is not None, 'Pipeline has no labels'
+            conditional['G'] = input_with_default(self.inputs.labels,
+                                                  'G/conditional')
+        # Duplicate the conditional (for the real and for the fake images).
+        both = tf.concat([conditional['G'], conditional['G']], axis=0)
+        conditional['D'] = input_with_default(both, 'D/conditional')
+        return conditional
 
     def _get_model_parameters(self, is_conditional):
         generator_inputs = [self.batch_size]
@@ -151,16 +242,13 @@ class GAN(model.Model):
                         var_list=self.generator.trainable_weights,
                         global_step=self.global_step)
 
-    def _maybe_with_summary(self, losses, tensors, with_summary):
-        if with_summary:
-            if all(len(t) > 1 for t in tensors.values()):
-                feed_dict = {self.summaries[k]: tensors[k][1] for k in tensors}
-                summary = self.session.run(self.combined_summary, feed_dict)
-            else:
-                summary = None
-            return losses, summary
-        else:
-            return losses
+    def _get_step_metrics(self, losses, tensors, metrics):
+        # Each entry of tensors is [loss] or [loss, summary] of one run.
+        summaries = [t[1] for t in tensors.values() if len(t) > 1]
+        return self._make_step_metrics(losses, metrics, summaries)
+
+    def _get_global_step_update(self):
+        return self.optimizer['G']
 
     def _get_summary_nodes(self):
         return {scope: util.merge_summaries(scope) for scope in 'DG'}
@@ -177,10 +265,11 @@ class GAN(model.Model):
             tf.summary.scalar('loss', self.loss['D'])
 
     def _expand_batch(self, batch):
+        # CellData already hands out dense arrays, which np.asarray won't copy.
         if self.is_conditional:
-            return np.array(batch[0]), np.array(batch[1])
+            return np.asarray(batch[0]), np.asarray(batch[1])
         else:
-            return np.array(batch), None
+            return np.asarray(batch), None
 
     def _get_conditional_embedding(self, scope):
         if not self.is_conditional:
@@ -51,18 +51,18 @@ def sample_variables(number_of_samples,
 
 
 class InfoGAN(dcgan.DCGAN):
-    def __init__(self, hyper, learning, session):
+    def __init__(self, hyper, learning, session, inputs=None):
         self.labels = None  # 0/1
         self.latent_prior = None  # c
         self.latent_posterior = None  # c|x
 
-        super(InfoGAN, self).__init__(hyper, learning, session)
+        super(InfoGAN, self).__init__(hyper, learning, session, inputs)
 
         assert self.probability_loss in ('mse', 'bce')
         assert self.continuous_loss in ('ll', 'bce')
 
     def _define_graph(self):
-        self.batch_size = Input(batch_shape=[1], name='batch_size')
+        self.batch_size = self._define_batch_size()
         self.latent_prior = Input(
             shape=[self.latent_size], name='latent_prior')
 
@@ -71,7 +71,7 @@ class InfoGAN(dcgan.DCGAN):
             full_latent = Concatenate(axis=1)([self.noise, self.latent_prior])
             self.fake_images = self._define_generator(full_latent)
 
-        self.images = Input(shape=self.image_shape, name='images')
+        self.images = self._define_discriminator_images()
         logits = self._define_discriminator(self.images)
         self.latent_posterior = Lambda(
             self._latent_layer, name='latent_posterior')(logits)
@@ -85,7 +85,7 @@ class InfoGAN(dcgan.DCGAN):
         self.generator = Model(generator_inputs, self.fake_images, name='G')
 
         self.loss = {}
-        self.labels = Input(batch_shape=[None], name='labels')
+        self.labels = self._define_discriminator_labels()
 
         self.discriminator = Model(self.images, self.probability, name='D')
         self.encoder = Model(self.images, self.latent_posterior, name='Q')
@@ -117,20 +117,56 @@ class InfoGAN(dcgan.DCGAN):
         return (images + 1) / 2.0 if rescale else images
 
     def train_on_batch(self, real_images, with_summary=False):
+        if self.inputs is not None:
+            return self._train_on_inputs(with_summary)
         batch_size = len(real_images)
         real_images = (np.array(real_images) * 2.0) - 1
 
         latent_prior = self.latent_distribution(batch_size)
-        fake_images = self.generate(batch_size, latent_prior, rescale=False)
+        with self.timer.phase('generate'):
+            fake_images = self.generate(
+                batch_size, latent_prior, rescale=False)
+
+        with self.timer.phase('update_D'):
+            d_tensors = self._train_discriminator(fake_images, real_images,
+                                                  with_summary)
+        with self.timer.phase('update_Q'):
+            q_loss = self._train_encoder(fake_images, latent_prior)
+        with self.timer.phase('update_G'):
+            g_tensors, metrics = self._train_generator(batch_size,
+                                                       with_summary)
 
-        d_tensors = self._train_discriminator(fake_images, real_images,
-                                              with_summary)
-        q_loss = self._train_encoder(fake_images, latent_prior)
-        g_tensors = self._train_generator(batch_size, with_summary)
+        losses = dict(D=d_tensors[0], G=g_tensors[0], Q=q_loss)
+        tensors = dict(D=d_tensors, G=g_tensors)
+        return self._get_step_metrics(losses, tensors, metrics)
+
+    def _train_on_inputs(self, with_summary):
+        batch_size = self.inputs.batch_size
+        latent_prior = self.latent_distribution(batch_size)
+
+        # The discriminator step generates the fakes from latent_prior, which
+        # we fetch for the encoder step.
+        fetches = [self.optimizer['D'], self.fake_images, self.loss['D']]
+        if with_summary and self.summaries['D'] is not None:
+            fetches.append(self.summaries['D'])
+        with self.timer.phase('update_D'):
+            results = self.session.run(
+                fetches,
+                feed_dict={
+                    self.latent_prior: latent_prior,
+                    K.learning_phase(): 1,
+                })
+        fake_images, d_tensors = results[1], results[2:]
+
+        with self.timer.phase('update_Q'):
+            q_loss = self._train_encoder(fake_images, latent_prior)
+        with self.timer.phase('update_G'):
+            g_tensors, metrics = self._train_generator(batch_size,
+                                                       with_summary)
 
         losses = dict(D=d_tensors[0], G=g_tensors[0], Q=q_loss)
         tensors = dict(D=d_tensors, G=g_tensors)
-        return self._maybe_with_summary(losses, tensors, with_summary)
+        return self._get_step_metrics(losses, tensors, metrics)
 
     def _train_discriminator(self, fake_images, real_images, with_summary):
         batch_size = len(fake_images)
@@ -154,7 +190,7 @@ class InfoGAN(dcgan.DCGAN):
 
     def _train_generator(self, batch_size, with_summary):
         latent_code = self.latent_distribution(batch_size)
-        fetches = [self.optimizer['G'], self.loss['G']]
+        fetches = [self.optimizer['G'], self.metrics, self.loss['G']]
         if with_summary and self.summaries['G'] is not None:
             fetches.append(self.summaries['G'])
 
@@ -166,7 +202,7 @@ class InfoGAN(dcgan.DCGAN):
                 K.learning_phase(): 1,
             })
 
-        return results[1:]
+        return results[2:], results[1]
 
     def _train_encoder(self, fake_images, latent_prior):
         # I(c; G(z, c))
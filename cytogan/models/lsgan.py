@@ -8,8 +8,8 @@ Hyper = dcgan.Hyper
 
 
 class LSGAN(dcgan.DCGAN):
-    def __init__(self, hyper, learning, session):
-        super(LSGAN, self).__init__(hyper, learning, session)
+    def __init__(self, hyper, learning, session, inputs=None):
+        super(LSGAN, self).__init__(hyper, learning, session, inputs)
 
     def _define_discriminator_loss(self, labels, probability):
         noisy_labels = gan.smooth_labels(labels)
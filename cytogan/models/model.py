@@ -1,17 +1,65 @@
 import abc
 
+import glob
+import json
 import os
+import threading
 import time
 
 import tensorflow as tf
 import collections
 
-from cytogan.extra import logs
+from cytogan.extra import logs, timing
 
 log = logs.get_logger(__name__)
 
 Learning = collections.namedtuple('Learning', 'rate, decay, steps_per_decay')
 
+# What train_on_batch returns: the loss(es), learning rate(s) and global step
+# after the update, plus the merged summary proto if one was requested.
+StepMetrics = collections.namedtuple('StepMetrics',
+                                     'loss, learning_rate, step, summary')
+
+
+def _iterator_state_path(checkpoint):
+    return '{0}.iterator.json'.format(checkpoint)
+
+
+class _CheckpointMirror(object):
+    '''
+    Copies of a list of variables in a graph (and session) of their own, so
+    that snapshots of the variables can be saved without touching the training
+    session. Checkpoints use the names of the original variables.
+    '''
+
+    def __init__(self, variables, **saver_options):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = []
+            mirrors = {}
+            assignments = []
+            for variable in variables:
+                dtype = variable.dtype.base_dtype
+                placeholder = tf.placeholder(dtype, variable.shape)
+                mirror = tf.Variable(
+                    tf.zeros(variable.shape, dtype), name=variable.op.name)
+                self.placeholders.append(placeholder)
+                mirrors[variable.op.name] = mirror
+                assignments.append(tf.assign(mirror, placeholder))
+            self.assign = tf.group(*assignments)
+            self.saver = tf.train.Saver(mirrors, **saver_options)
+        # The copies live in host memory.
+        config = tf.ConfigProto(device_count={'GPU': 0})
+        self.session = tf.Session(graph=self.graph, config=config)
+
+    def save(self, values, checkpoint_path, global_step):
+        self.session.run(self.assign, dict(zip(self.placeholders, values)))
+        return self.saver.save(
+            self.session,
+            checkpoint_path,
+            global_step=global_step,
+            write_meta_graph=False)
+
 
 class Model(abc.ABC):
     def __init__(self, learning, session):
@@ -20,6 +68,14 @@ class Model(abc.ABC):
         self.session = session
         self.optimizer = None
         self._learning_rate = None
+        # Anything with get_state()/set_state() (like CellData) whose state we
+        # should checkpoint alongside the model.
+        self.data_iterator = None
+        # For asynchronous checkpoints (see save()).
+        self._checkpoint_mirror = None
+        self._checkpoint_thread = None
+        # Wall time of the phases of each training step.
+        self.timer = timing.StepTimer()
 
         # The training step indicator variable.
         self.global_step = tf.Variable(0, trainable=False)
@@ -30,10 +86,16 @@ class Model(abc.ABC):
         # Attach an optimizer and get the final learning rate tensor.
         self._add_optimizer(learning)
 
+        # Fetched along with the update that advances the global step.
+        self.metrics = self._define_metrics()
+
         # Boilerplate for management of the model execution.
         self._add_summaries()
-        self.saver = tf.train.Saver(
+        self._checkpoint_variables = tf.global_variables()
+        self._saver_options = dict(
             max_to_keep=2, keep_checkpoint_every_n_hours=6)
+        self.saver = tf.train.Saver(self._checkpoint_variables,
+                                    **self._saver_options)
 
     @abc.abstractmethod
     def train_on_batch(self, batch, with_summary=False):
@@ -74,14 +136,56 @@ class Model(abc.ABC):
     def is_generative(self):
         return hasattr(self, 'generate')
 
-    def save(self, checkpoint_directory):
+    def save(self, checkpoint_directory, asynchronous=False):
+        '''
+        Saves a checkpoint. Asynchronously, this only copies all variables to
+        host memory (in one fetch) and writes the checkpoint on a background
+        thread. Returns False if that is not possible because the previous
+        asynchronous save is still being written.
+        '''
+        if self.is_saving:
+            if not asynchronous:
+                self.wait_for_checkpoint()
+            else:
+                log.warning('Skipping checkpoint: still writing the last one')
+                return False
         if not os.path.exists(checkpoint_directory):
             os.makedirs(checkpoint_directory)
         timestamp = time.strftime('%d-%m-%Y_%H-%M-%S')
         model_key = '{0}_{1}'.format(self.name, timestamp)
         checkpoint_path = os.path.join(checkpoint_directory, model_key)
-        self.saver.save(
-            self.session, checkpoint_path, global_step=self.global_step)
+        if self.data_iterator is not None:
+            iterator_state = self.data_iterator.get_state()
+        else:
+            iterator_state = None
+
+        if not asynchronous:
+            checkpoint = self.saver.save(
+                self.session, checkpoint_path, global_step=self.global_step)
+            if iterator_state is not None:
+                self._save_iterator_state(checkpoint, iterator_state)
+            return True
+
+        if self._checkpoint_mirror is None:
+            self._checkpoint_mirror = _CheckpointMirror(
+                self._checkpoint_variables, **self._saver_options)
+        values, step = self.session.run(
+            [self._checkpoint_variables, self.global_step])
+        self._checkpoint_thread = threading.Thread(
+            target=self._write_checkpoint,
+            args=(values, checkpoint_path, step, iterator_state))
+        self._checkpoint_thread.start()
+        return True
+
+    @property
+    def is_saving(self):
+        thread = self._checkpoint_thread
+        return thread is not None and thread.is_alive()
+
+    def wait_for_checkpoint(self):
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
 
     def restore(self, checkpoint_path):
         if os.path.isdir(checkpoint_path):
@@ -94,6 +198,69 @@ class Model(abc.ABC):
                     checkpoint_path))
         log.info('Restoring from {0}'.format(checkpoint))
         self.saver.restore(self.session, checkpoint)
+        if self.data_iterator is not None:
+            self._restore_iterator_state(checkpoint)
+
+    def _write_checkpoint(self, values, checkpoint_path, step,
+                          iterator_state):
+        try:
+            checkpoint = self._checkpoint_mirror.save(values, checkpoint_path,
+                                                      step)
+            if iterator_state is not None:
+                self._save_iterator_state(checkpoint, iterator_state)
+        except Exception:
+            log.exception('Could not write checkpoint %s', checkpoint_path)
+
+    def _save_iterator_state(self, checkpoint, state):
+        with open(_iterator_state_path(checkpoint), 'w') as state_file:
+            json.dump(state, state_file)
+        # Drop states of checkpoints the saver has deleted in the meantime.
+        directory = os.path.dirname(checkpoint)
+        for path in glob.glob(os.path.join(directory, '*.iterator.json')):
+            prefix = path[:-len('.iterator.json')]
+            if not os.path.exists('{0}.index'.format(prefix)):
+                os.remove(path)
+
+    def _restore_iterator_state(self, checkpoint):
+        path = _iterator_state_path(checkpoint)
+        if not os.path.exists(path):
+            log.warning('No data iterator state found for %s', checkpoint)
+            return
+        with open(path) as state_file:
+            self.data_iterator.set_state(json.load(state_file))
+
+    def _get_global_step_update(self):
+        # The update op that advances the global step once per training step.
+        return self.optimizer
+
+    def _define_metrics(self):
+        # Read the global step only once its update has run.
+        with tf.control_dependencies([self._get_global_step_update()]):
+            step = tf.identity(self.global_step, name='step')
+        # Learning rates without decay are plain floats.
+        if isinstance(self._learning_rate, dict):
+            learning_rate = {
+                key: tf.convert_to_tensor(lr)
+                for key, lr in self._learning_rate.items()
+            }
+        else:
+            learning_rate = tf.convert_to_tensor(self._learning_rate)
+        return dict(learning_rate=learning_rate, step=step)
+
+    def _make_step_metrics(self, loss, metrics, summaries=None):
+        # Summaries are serialized Summary protos, so merging them is just
+        # concatenating their values (no need to run a merge op).
+        if summaries:
+            summary = tf.Summary()
+            for serialized in summaries:
+                summary.MergeFromString(serialized)
+        else:
+            summary = None
+        return StepMetrics(
+            loss=loss,
+            learning_rate=metrics['learning_rate'],
+            step=int(metrics['step']),
+            summary=summary)
 
     def _get_learning_rate_tensor(self, initial_learning_rate, decay_rate,
                                   steps_per_decay):
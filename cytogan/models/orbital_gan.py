@@ -116,15 +116,19 @@ class OrbitalGAN(lsgan.LSGAN):
         real_images, labels = batch
         real_images = (real_images * 2.0) - 1
         batch_size = len(real_images)
-        fake_images = self.generate(batch_size, rescale=False)
+        with self.timer.phase('generate'):
+            fake_images = self.generate(batch_size, rescale=False)
 
-        d_tensors = self._train_discriminator(fake_images, real_images, labels,
-                                              with_summary)
-        g_tensors = self._train_generator(batch_size, None, with_summary)
+        with self.timer.phase('update_D'):
+            d_tensors = self._train_discriminator(fake_images, real_images,
+                                                  labels, with_summary)
+        with self.timer.phase('update_G'):
+            g_tensors, metrics = self._train_generator(
+                batch_size, None, with_summary)
 
         losses = dict(D=d_tensors[0], G=g_tensors[0])
         tensors = dict(D=d_tensors, G=g_tensors)
-        return self._maybe_with_summary(losses, tensors, with_summary)
+        return self._get_step_metrics(losses, tensors, metrics)
 
     def _add_summaries(self):
         super(OrbitalGAN, self)._add_summaries()
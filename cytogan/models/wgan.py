@@ -8,8 +8,8 @@ Hyper = dcgan.Hyper
 
 
 class WGAN(dcgan.DCGAN):
-    def __init__(self, hyper, learning, session):
-        super(WGAN, self).__init__(hyper, learning, session)
+    def __init__(self, hyper, learning, session, inputs=None):
+        super(WGAN, self).__init__(hyper, learning, session, inputs)
 
     def _define_discriminator_loss(self, _, logits):
         with K.name_scope('D_loss'):
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cytogan.data import shards
+from cytogan.data.cell_data import CellData
+
+COMPOUNDS = ['DMSO', 'A', 'B']
+CONCENTRATIONS = [0.0, 0.1, 0.3]
+IMAGE_SHAPE = (4, 4, 3)
+
+
+@pytest.fixture
+def make_cell_data(tmpdir):
+    '''
+    Returns a function building a CellData over a small shard directory, with
+    number_of_images images (over two plates) of cells_per_image cells each.
+    Every cell image is filled with cell_value() of its key. Without
+    with_shards, the CellData reads from an image root through a cell count
+    file instead, but the images themselves are left to the caller.
+    '''
+
+    def make(number_of_images=6,
+             cells_per_image=3,
+             with_shards=True,
+             **kwargs):
+        directory = str(tmpdir)
+        rows = []
+        for index in range(number_of_images):
+            rows.append({
+                'Image_Metadata_Plate_DAPI': 'P{0}'.format(index % 2),
+                'Image_FileName_DAPI': 'f{0}.tif'.format(index),
+                'Image_Metadata_Compound': COMPOUNDS[index % 3],
+                'Image_Metadata_Concentration': CONCENTRATIONS[index % 3],
+            })
+        metadata_path = '{0}/metadata.csv'.format(directory)
+        pd.DataFrame(rows).to_csv(metadata_path, index=False)
+        moa = dict(
+            compound=['A', 'B', 'DMSO'],
+            concentration=[0.1, 0.3, 0.0],
+            moa=['x', 'y', 'control'])
+        moa_path = '{0}/moa.csv'.format(directory)
+        pd.DataFrame(moa).to_csv(moa_path, index=False)
+
+        if not with_shards:
+            cell_count_path = '{0}/cell_counts.csv'.format(directory)
+            with open(cell_count_path, 'w') as cell_count_file:
+                cell_count_file.write('key, number_of_cells\n')
+                for index in range(number_of_images):
+                    cell_count_file.write('P{0}/f{1},{2}\n'.format(
+                        index % 2, index, cells_per_image))
+            return CellData(
+                metadata_path,
+                moa_path,
+                '{0}/images'.format(directory),
+                cell_count_path=cell_count_path,
+                **kwargs)
+
+        shard_path = '{0}/shards'.format(directory)
+        with shards.ShardWriter(shard_path, IMAGE_SHAPE) as writer:
+            for index in range(number_of_images):
+                for cell in range(cells_per_image):
+                    key = 'P{0}/f{1}-{2}'.format(index % 2, index, cell)
+                    writer.append(key, cell_image(key, cells_per_image))
+
+        return CellData(
+            metadata_path, moa_path, None, shard_path=shard_path, **kwargs)
+
+    return make
+
+
+def cell_value(key, cells_per_image=3):
+    # P{plate}/f{index}-{cell} -> index * cells_per_image + cell
+    image_key, cell = key.rsplit('-', 1)
+    index = int(image_key.rsplit('/f', 1)[1])
+    return index * cells_per_image + int(cell)
+
+
+def cell_image(key, cells_per_image=3):
+    return np.full(IMAGE_SHAPE, cell_value(key, cells_per_image), np.uint8)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from cytogan.data import image_loader
+from cytogan.test import conftest
+
+
+def _batches(cell_data, number_of_batches, batch_size=4):
+    return [
+        cell_data.next_batch(batch_size, with_keys=True)[0]
+        for _ in range(number_of_batches)
+    ]
+
+
+def test_state_round_trip_resumes_exactly(make_cell_data):
+    cell_data = make_cell_data(seed=5)
+    # 18 cells per epoch, so this crosses an epoch boundary.
+    _batches(cell_data, 6)
+    state = cell_data.get_state()
+    assert state['epoch'] == 1
+    expected = _batches(cell_data, 5)
+
+    resumed = make_cell_data(seed=5)
+    resumed.set_state(state)
+    assert resumed.get_state() == state
+    assert _batches(resumed, 5) == expected
+
+
+def test_rows_and_batches_share_the_state(make_cell_data):
+    cell_data = make_cell_data(seed=2)
+    rows = cell_data.iterate_rows()
+    for _ in range(20):
+        next(rows)
+    state = cell_data.get_state()
+    assert (state['epoch'], state['batch_index']) == (1, 2)
+    expected = [next(rows) for _ in range(10)]
+
+    resumed = make_cell_data(seed=2)
+    resumed.set_state(state)
+    resumed_rows = resumed.iterate_rows()
+    assert [next(resumed_rows) for _ in range(10)] == expected
+
+
+def test_state_never_points_past_the_end_of_an_epoch(make_cell_data):
+    cell_data = make_cell_data(seed=1)
+    rows = cell_data.iterate_rows()
+    for _ in range(18):
+        next(rows)
+    state = cell_data.get_state()
+    assert (state['epoch'], state['batch_index']) == (1, 0)
+
+
+def test_state_is_per_shard(make_cell_data):
+    state = make_cell_data(seed=1, rank=0, world_size=2).get_state()
+    with pytest.raises(AssertionError):
+        make_cell_data(seed=1).set_state(state)
+
+
+def test_evaluation_leaves_training_state_alone(make_cell_data):
+    cell_data = make_cell_data(seed=3)
+    _batches(cell_data, 2)
+    state = cell_data.get_state()
+    keys = []
+    for batch_keys, _ in cell_data.batches_of_size(4):
+        keys += batch_keys
+    assert len(keys) == cell_data.number_of_images
+    assert cell_data.get_state() == state
+    assert np.all(np.array(keys) == cell_data.keys)
+
+
+def test_oversized_batches_from_shared_memory(make_cell_data, monkeypatch):
+    def load_image(root_path, image_key, extension):
+        return conftest.cell_image(image_key)
+
+    # The worker pool is forked when the CellData is built.
+    monkeypatch.setattr(image_loader, 'load_image', load_image)
+    cell_data = make_cell_data(
+        number_of_images=10,
+        seed=6,
+        with_shards=False,
+        image_shape=conftest.IMAGE_SHAPE,
+        shared_memory_batch_size=4)
+    # Twice, so that the second batch comes from chunks prefetched by the
+    # first.
+    for _ in range(2):
+        keys, images = cell_data.next_batch(10, with_keys=True)
+        assert len(keys) == 10
+        assert images.shape == (10, ) + conftest.IMAGE_SHAPE
+        values = [conftest.cell_value(key) / 255 for key in keys]
+        np.testing.assert_allclose(images[:, 0, 0, 0], values, rtol=1e-6)
@@ -0,0 +1,36 @@
+import logging
+
+from cytogan.extra import logs
+
+
+def _record(message):
+    return logging.LogRecord('raw', logging.INFO, __file__, 0, message, (),
+                             None)
+
+
+def test_throttled_file_handler_keeps_last_write_before_line_end(tmpdir):
+    path = str(tmpdir.join('log.txt'))
+    handler = logs.ThrottledFileHandler(path, min_interval=60)
+    handler.terminator = ''
+    for message in ['\r1%', '\r2%', '\r3%', '\n', '\r4%']:
+        handler.handle(_record(message))
+    handler.close()
+    with open(path, newline='') as log_file:
+        assert log_file.read() == '\r1%\r3%\n'
+
+
+def test_log_file_writes_everything():
+    records = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    logger = logging.getLogger('cytogan-test-log-file')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(Handler())
+    log_file = logs.LogFile(logger)
+    for message in ['\r1%', '\r2%', '\n']:
+        log_file.write(message)
+    assert records == ['\r1%', '\r2%', '\n']
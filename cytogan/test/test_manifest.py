@@ -0,0 +1,46 @@
+import os
+
+from cytogan.data import manifest
+
+PLATES = ['P0', 'P1']
+IMAGES = ['a', 'b']
+
+
+def _touch(path):
+    open(path, 'w').close()
+
+
+def _make_images(root):
+    for plate, name in zip(PLATES, IMAGES):
+        os.makedirs(os.path.join(root, plate))
+        for cell in range(2):
+            _touch(os.path.join(root, plate, '{0}-{1}.png'.format(name, cell)))
+
+
+def _names(root, directory):
+    indices, keys = manifest.get_single_cell_names(
+        root, PLATES, IMAGES, None, directory=directory)
+    return list(indices), keys
+
+
+def test_manifest_is_reused(tmpdir):
+    root, directory = str(tmpdir.mkdir('images')), str(tmpdir.mkdir('cache'))
+    _make_images(root)
+    first = _names(root, directory)
+    assert first == ([0, 0, 1, 1], ['P0/a-0', 'P0/a-1', 'P1/b-0', 'P1/b-1'])
+    assert len(os.listdir(directory)) == 1
+    assert _names(root, directory) == first
+
+
+def test_manifest_is_stale_when_a_plate_changes(tmpdir):
+    root, directory = str(tmpdir.mkdir('images')), str(tmpdir.mkdir('cache'))
+    _make_images(root)
+    _names(root, directory)
+    plate_path = os.path.join(root, 'P1')
+    _touch(os.path.join(plate_path, 'b-2.png'))
+    # Make the change visible even with a coarse mtime resolution.
+    mtime = os.path.getmtime(plate_path) + 10
+    os.utime(plate_path, (mtime, mtime))
+    indices, keys = _names(root, directory)
+    assert keys[-1] == 'P1/b-2'
+    assert indices == [0, 0, 1, 1, 1]
@@ -0,0 +1,134 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('future')
+pytest.importorskip('matplotlib')
+
+from cytogan.data import shards  # noqa: E402
+from scripts import mask  # noqa: E402
+
+
+def test_ledger_drops_partial_last_line(tmpdir):
+    path = str(tmpdir.join('ledger.csv'))
+    with open(path, 'w') as ledger_file:
+        ledger_file.write(mask.Ledger.HEADER)
+        ledger_file.write('P0/a,3,shards,1\n')
+        ledger_file.write('P0/b,5,shards,')
+
+    ledger = mask.Ledger(path)
+    assert 'P0/a' in ledger
+    assert 'P0/b' not in ledger
+    assert ledger.number_of_cells == 3
+    ledger.append('P0/b', 5, 'shards')
+    ledger.close()
+
+    with open(path) as ledger_file:
+        lines = ledger_file.read().splitlines()
+    assert lines == [mask.Ledger.HEADER.strip(), 'P0/a,3,shards,1',
+                     'P0/b,5,shards,1']
+    assert len(mask.Ledger(path)) == 2
+
+
+def test_ledger_keeps_partial_images_to_redo(tmpdir):
+    path = str(tmpdir.join('ledger.csv'))
+    ledger = mask.Ledger(path)
+    ledger.append('P0/a', 3, 'shards')
+    ledger.append('P0/b', 0, 'shards', complete=False)
+    ledger.close()
+
+    ledger = mask.Ledger(path)
+    assert 'P0/b' not in ledger
+    assert ledger.partial_images == {'P0/b'}
+    ledger.append('P0/b', 2, 'shards')
+    ledger.close()
+    ledger = mask.Ledger(path)
+    assert list(ledger.cell_counts.items()) == [('P0/a', 3), ('P0/b', 2)]
+    assert not ledger.partial_images
+
+
+def test_ledger_rewrites_cell_counts(tmpdir):
+    path = str(tmpdir.join('ledger.csv'))
+    cell_count_path = str(tmpdir.join('cell_counts.csv'))
+    ledger = mask.Ledger(path)
+    ledger.append('P0/a,x', 2, 'shards')
+    ledger.close()
+
+    ledger = mask.Ledger(path, cell_count_path)
+    ledger.append('P0/b', 3, 'shards')
+    ledger.close()
+    with open(cell_count_path) as cell_count_file:
+        lines = cell_count_file.read().splitlines()
+    assert lines[1:] == ['"P0/a,x",2', 'P0/b,3']
+    cell_counts = pd.read_csv(cell_count_path, skipinitialspace=True)
+    assert list(cell_counts['key']) == ['P0/a,x', 'P0/b']
+    assert list(cell_counts['number_of_cells']) == [2, 3]
+
+
+def _fake_image(image_path):
+    # Three "cells": the background and two labelled squares.
+    image_mask = np.zeros((16, 16), np.uint8)
+    image_mask[2:6, 2:6] = 1
+    image_mask[9:14, 9:14] = 2
+    channel = np.full((16, 16), 100.0)
+    return mask.Image(channel, channel, channel, image_mask)
+
+
+def _mask_images(output, keys, cell_limit):
+    options = argparse.Namespace(
+        size=8,
+        display=False,
+        output=output,
+        output_format='shards',
+        cells_per_shard=100,
+        cell_limit=cell_limit,
+        image_limit=None,
+        max_in_flight=1)
+    image_paths = [mask.ImagePath(*([None] * 4), prefix=k) for k in keys]
+    ledger = mask.Ledger('{0}/ledger.csv'.format(output))
+    try:
+        return mask.mask_images(image_paths, options, ledger)
+    finally:
+        ledger.close()
+
+
+def test_resume_redoes_images_cut_short_by_cell_limit(tmpdir, monkeypatch):
+    monkeypatch.setattr(mask, 'read_images', _fake_image)
+    output = str(tmpdir)
+    keys = ['P0/a', 'P0/b', 'P0/c']
+
+    _, cells, _, errors = _mask_images(output, keys, cell_limit=5)
+    assert (cells, errors) == (5, 0)
+    ledger = mask.Ledger('{0}/ledger.csv'.format(output))
+    assert list(ledger.cell_counts) == ['P0/a']
+    # P0/c may have been queued before the limit was hit, getting no cells.
+    assert 'P0/b' in ledger.partial_images
+    ledger.close()
+
+    images, cells, skipped, errors = _mask_images(output, keys, None)
+    assert (images, cells, skipped, errors) == (2, 6, 1, 0)
+    ledger = mask.Ledger('{0}/ledger.csv'.format(output))
+    assert ledger.cell_counts == dict.fromkeys(keys, 3)
+    assert not ledger.partial_images
+    ledger.close()
+
+    loader = shards.ShardImageLoader(output)
+    assert sorted(loader.keys) == sorted(
+        '{0}-{1}'.format(key, cell) for key in keys for cell in range(3))
+
+
+def test_failed_images_release_their_cells(tmpdir, monkeypatch):
+    monkeypatch.setattr(mask, 'read_images', _fake_image)
+    write_shards = mask.MaskJob._write_shards
+
+    def failing_write_shards(job, image_key, cells):
+        if image_key == 'P0/a':
+            raise IOError('disk full')
+        return write_shards(job, image_key, cells)
+
+    monkeypatch.setattr(mask.MaskJob, '_write_shards', failing_write_shards)
+    keys = ['P0/a', 'P0/b', 'P0/c']
+    _, cells, _, errors = _mask_images(str(tmpdir), keys, cell_limit=6)
+    assert (cells, errors) == (6, 1)
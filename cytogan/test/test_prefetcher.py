@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('tqdm')
+
+from cytogan.train.trainer import BatchPrefetcher  # noqa: E402
+
+
+def test_prefetcher_reports_the_state_of_consumed_batches(make_cell_data):
+    cell_data = make_cell_data(seed=4)
+    reference = make_cell_data(seed=4)
+    prefetcher = BatchPrefetcher(
+        cell_data.next_batch, 4, depth=3, data_iterator=cell_data)
+    try:
+        assert prefetcher.get_state() == reference.get_state()
+        for _ in range(7):
+            batch = prefetcher(4)
+            expected = reference.next_batch(4)
+            assert (batch == expected).all()
+            assert prefetcher.get_state() == reference.get_state()
+    finally:
+        prefetcher.close()
+    # Restoring the consumed state continues where training stopped.
+    cell_data.set_state(prefetcher.get_state())
+    assert (cell_data.next_batch(4) == reference.next_batch(4)).all()
+
+
+def test_prefetcher_reraises_errors():
+    def failing(batch_size):
+        raise ValueError('bad batch')
+
+    prefetcher = BatchPrefetcher(failing, 4, depth=2)
+    with pytest.raises(ValueError):
+        prefetcher(4)
+    prefetcher.close()
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('sklearn')
+
+from cytogan.metrics import profiling  # noqa: E402
+
+
+def _profiles():
+    index = pd.Index(['P0/a-0', 'P0/a-1', 'P1/b-0'], name='key')
+    profiles = pd.DataFrame(
+        dict(
+            compound=['DMSO', 'A', 'B'],
+            concentration=[0.0, 0.1, 0.3],
+            moa=['control', 'x', 'y']),
+        index=index)
+    profiles['profile'] = [np.arange(4) + i for i in range(3)]
+    return profiles
+
+
+def test_h5_profiles_round_trip(tmpdir):
+    path = str(tmpdir.join('profiles.h5'))
+    profiles = _profiles()
+    profiling.save_profiles(path, profiles)
+    loaded = profiling.load_profiles(path)
+
+    assert loaded.index.name == 'key'
+    assert list(loaded.index) == list(profiles.index)
+    assert list(loaded.columns) == list(profiles.columns)
+    assert list(loaded['compound']) == ['DMSO', 'A', 'B']
+    np.testing.assert_allclose(loaded['concentration'], [0.0, 0.1, 0.3])
+    for original, row in zip(profiles['profile'], loaded['profile']):
+        assert row.dtype == np.float32
+        np.testing.assert_array_equal(row, original)
+
+
+def test_h5_profiles_without_index_name(tmpdir):
+    path = str(tmpdir.join('profiles.hdf5'))
+    profiles = _profiles()
+    profiles.index.name = None
+    profiling.save_profiles(path, profiles)
+    assert profiling.load_profiles(path).index.name is None
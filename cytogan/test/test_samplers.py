@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from cytogan.data import samplers
+
+
+def test_sampler_is_abstract():
+    with pytest.raises(TypeError):
+        samplers.Sampler(10)
+
+
+def test_uniform_order_depends_only_on_seed_and_epoch():
+    first = samplers.UniformSampler(100, seed=3)
+    second = samplers.UniformSampler(100, seed=3)
+    np.testing.assert_array_equal(first.indices(5), second.indices(5))
+    assert not np.array_equal(first.indices(5), first.indices(6))
+    other_seed = samplers.UniformSampler(100, seed=4)
+    assert not np.array_equal(first.indices(5), other_seed.indices(5))
+
+
+def test_uniform_visits_every_item_once():
+    indices = samplers.UniformSampler(100, seed=0).indices(0)
+    np.testing.assert_array_equal(np.sort(indices), np.arange(100))
+
+
+def test_uniform_shards_are_disjoint_and_evenly_sized():
+    world_size = 3
+    shards = [
+        samplers.UniformSampler(100, rank, world_size, seed=1).indices(2)
+        for rank in range(world_size)
+    ]
+    assert all(len(shard) == 100 // world_size for shard in shards)
+    union = np.concatenate(shards)
+    assert len(np.unique(union)) == len(union)
+
+
+def test_invalid_rank():
+    with pytest.raises(AssertionError):
+        samplers.UniformSampler(10, rank=2, world_size=2)
+
+
+def test_stratified_balances_strata():
+    # One large stratum and two small ones.
+    strata = np.array([0] * 900 + [1] * 50 + [2] * 50)
+    sampler = samplers.StratifiedSampler(strata, seed=0)
+    indices = sampler.indices(0)
+    assert len(indices) == len(strata)
+    counts = np.bincount(strata[indices], minlength=3)
+    np.testing.assert_allclose(counts / len(indices), 1 / 3, atol=0.05)
+
+
+def test_stratified_is_deterministic_and_sharded():
+    strata = np.arange(60) % 4
+    first = samplers.StratifiedSampler(strata, rank=1, world_size=2, seed=7)
+    second = samplers.StratifiedSampler(strata, rank=1, world_size=2, seed=7)
+    np.testing.assert_array_equal(first.indices(3), second.indices(3))
+    assert len(first.indices(3)) == 30
+    other_rank = samplers.StratifiedSampler(strata, 0, 2, seed=7)
+    assert not np.array_equal(first.indices(3), other_rank.indices(3))
@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+
+from cytogan.data import shards
+
+SHAPE = (4, 4, 3)
+
+
+def _cell(value):
+    return np.full(SHAPE, value, dtype=np.uint8)
+
+
+def test_writer_and_loader_round_trip(tmpdir):
+    directory = str(tmpdir)
+    with shards.ShardWriter(directory, SHAPE, cells_per_shard=2) as writer:
+        for index in range(5):
+            writer.append('P/image-{0}'.format(index), _cell(index))
+
+    assert shards.read_image_shape(directory) == SHAPE
+    shard_files = [f for f in os.listdir(directory) if f.endswith('.bin')]
+    assert len(shard_files) == 3
+
+    loader = shards.ShardImageLoader(directory)
+    assert list(loader.keys) == ['P/image-{0}'.format(i) for i in range(5)]
+    keys, images = loader[['P/image-4', 'P/image-1']]
+    assert keys == ['P/image-4', 'P/image-1']
+    np.testing.assert_array_equal(images[0], _cell(4))
+    np.testing.assert_array_equal(images[1], _cell(1))
+
+
+def test_loader_skips_missing_keys(tmpdir):
+    directory = str(tmpdir)
+    with shards.ShardWriter(directory, SHAPE) as writer:
+        writer.append('P/image-0', _cell(0))
+
+    keys, images = shards.ShardImageLoader(directory)[['P/image-0', 'nope']]
+    assert keys == ['P/image-0']
+    assert len(images) == 1
+
+
+def test_writers_append_to_existing_directory(tmpdir):
+    directory = str(tmpdir)
+    with shards.ShardWriter(directory, SHAPE) as writer:
+        writer.append('P/image-0', _cell(0))
+    with shards.ShardWriter(directory, SHAPE) as writer:
+        writer.append('P/image-1', _cell(1))
+
+    loader = shards.ShardImageLoader(directory)
+    assert len(loader.shards) == 2
+    _, images = loader[['P/image-0', 'P/image-1']]
+    np.testing.assert_array_equal(images[0], _cell(0))
+    np.testing.assert_array_equal(images[1], _cell(1))
+
+
+def test_external_index_rows(tmpdir):
+    directory = str(tmpdir)
+    writer = shards.ShardWriter(
+        directory, SHAPE, prefix='worker', write_index=False)
+    rows = [writer.append('P/image-{0}'.format(i), _cell(i)) for i in range(2)]
+    writer.close()
+    assert rows == [('P/image-0', 'worker-00000.bin', 0),
+                    ('P/image-1', 'worker-00000.bin', 1)]
+    assert not os.path.exists(os.path.join(directory, shards.INDEX_FILE))
+
+    columns = shards.INDEX_COLUMNS + ['cell']
+    with shards.open_index(directory, columns) as index_file:
+        for row in rows:
+            index_file.write('{0},{1},{2},{3}\n'.format(*(row + (row[2], ))))
+    index = shards.read_index(directory)
+    assert list(index.columns) == ['shard', 'offset', 'cell']
+    _, images = shards.ShardImageLoader(directory)[['P/image-1']]
+    np.testing.assert_array_equal(images[0], _cell(1))
+
+
+def test_rewritten_cells_supersede_earlier_rows(tmpdir):
+    directory = str(tmpdir)
+    with shards.ShardWriter(directory, SHAPE) as writer:
+        writer.append('P/image-0', _cell(0))
+        writer.append('P/image-1', _cell(1))
+    # Like a resumed segmentation run writing the same image again.
+    with shards.ShardWriter(directory, SHAPE) as writer:
+        writer.append('P/image-0', _cell(7))
+
+    loader = shards.ShardImageLoader(directory)
+    assert sorted(loader.keys) == ['P/image-0', 'P/image-1']
+    _, images = loader[['P/image-0']]
+    np.testing.assert_array_equal(images[0], _cell(7))
+
+
+def test_loader_ignores_truncated_shards(tmpdir):
+    directory = str(tmpdir)
+    with shards.ShardWriter(directory, SHAPE) as writer:
+        for index in range(3):
+            writer.append('P/image-{0}'.format(index), _cell(index))
+    # Like a writer that crashed half way through its last cell.
+    shard_path = os.path.join(directory, 'shard-00000.bin')
+    with open(shard_path, 'rb+') as shard_file:
+        shard_file.truncate(os.path.getsize(shard_path) - 5)
+
+    loader = shards.ShardImageLoader(directory)
+    assert list(loader.keys) == ['P/image-0', 'P/image-1']
+    assert len(loader.shards['shard-00000.bin']) == 2
+    keys, images = loader[['P/image-1', 'P/image-2']]
+    assert keys == ['P/image-1']
+    np.testing.assert_array_equal(images[0], _cell(1))
+
+
+def test_loader_ignores_empty_shards(tmpdir):
+    directory = str(tmpdir)
+    with shards.ShardWriter(directory, SHAPE) as writer:
+        writer.append('P/image-0', _cell(0))
+    open(os.path.join(directory, 'shard-00000.bin'), 'wb').close()
+
+    loader = shards.ShardImageLoader(directory)
+    assert len(loader.keys) == 0
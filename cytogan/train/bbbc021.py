@@ -7,6 +7,7 @@ import scipy.misc
 import tensorflow as tf
 from tqdm import tqdm
 
+from cytogan.data import pipeline, samplers
 from cytogan.data.cell_data import CellData
 from cytogan.experiments import visualize, algebra, interpolation
 from cytogan.extra import distributions, logs, misc
@@ -23,7 +24,10 @@ parser.add_argument('--image-algebra-display-size', type=int, default=5)
 parser.add_argument('--image-algebra-equations', type=int, default=1)
 parser.add_argument('--image-algebra-sample-size', type=int, default=100)
 parser.add_argument('--image-algebra', nargs='+', choices=algebra.EXPERIMENTS)
-parser.add_argument('--images', required=True)
+parser.add_argument('--image-cache-mb', type=int)
+parser.add_argument('--images')
+parser.add_argument('--input-pipeline', action='store_true')
+parser.add_argument('--input-pipeline-threads', type=int, default=8)
 parser.add_argument('--interpolate-treatment-compound')
 parser.add_argument(
     '--interpolate-treatment-concentrations', nargs='+', type=float)
@@ -37,19 +41,31 @@ parser.add_argument('--latent-moa', action='store_true')
 parser.add_argument('--load-cell-data', action='store_true')
 parser.add_argument('--load-profiles')
 parser.add_argument('--load-treatment-profiles')
+parser.add_argument('--manifest-dir')
 parser.add_argument('--metadata', required=True)
 parser.add_argument('--no-latent-embedding', action='store_true')
 parser.add_argument('--noise-file')
 parser.add_argument('--normalize-luminance', action='store_true')
+parser.add_argument(
+    '--profile-format', choices=profiling.PROFILE_FORMATS, default='h5')
+parser.add_argument('--rank', type=int, default=0)
 parser.add_argument('--save-profiles', action='store_true')
 parser.add_argument('--save-generated-images', action='store_true')
+parser.add_argument('--sampler', choices=samplers.SAMPLERS, default='uniform')
+parser.add_argument('--shards')
+parser.add_argument('--shared-memory-batches', action='store_true')
 parser.add_argument('--skip-evaluation', action='store_true')
 parser.add_argument('--store-generated-noise', action='store_true')
 parser.add_argument('--tsne-perplexity', type=int)
 parser.add_argument('--vector-distance', action='store_true')
 parser.add_argument('--whiten-profiles', action='store_true')
+parser.add_argument('--world-size', type=int, default=1)
 parser.add_argument('-p', '--pattern', action='append')
 options = common.parse_args(parser)
+assert options.images or options.shards, 'Need --images or --shards'
+if options.input_pipeline:
+    assert options.model not in ('ae', 'conv_ae', 'vae'), \
+        '--input-pipeline only works with GANs'
 
 if options.save_profiles:
     assert options.workspace is not None, 'Need workspace to store profiles'
@@ -58,7 +74,8 @@ if options.save_profiles:
         os.makedirs(options.profiles_dir)
 
     def save_profiles(profiles, prefix):
-        filename = '{0}.csv.gz'.format(prefix)
+        extension = 'h5' if options.profile_format == 'h5' else 'csv.gz'
+        filename = '{0}.{1}'.format(prefix, extension)
         log.info('Storing %s to disk', filename)
         path = os.path.join(options.profiles_dir, filename)
         profiling.save_profiles(path, profiles)
@@ -70,17 +87,39 @@ log.debug('Options:\n%s', options.as_string)
 if not options.show_figures:
     visualize.disable_display()
 
+image_shape = (96, 96, 3)
 if not options.skip_evaluation or options.load_cell_data:
-    cell_data = CellData(options.metadata, options.labels, options.images,
-                         options.cell_count_file, options.pattern,
-                         options.normalize_luminance, options.conditional,
-                         options.concentration_only_labels)
+    if options.shared_memory_batches:
+        shared_memory_batch_size = options.batch_size
+    else:
+        shared_memory_batch_size = None
+    if options.image_cache_mb is not None:
+        image_cache_size = options.image_cache_mb * 1024 * 1024
+    else:
+        image_cache_size = None
+    cell_data = CellData(
+        options.metadata,
+        options.labels,
+        options.images,
+        options.cell_count_file,
+        options.pattern,
+        options.normalize_luminance,
+        options.conditional,
+        options.concentration_only_labels,
+        shard_path=options.shards,
+        image_shape=image_shape,
+        shared_memory_batch_size=shared_memory_batch_size,
+        image_cache_size=image_cache_size,
+        manifest_directory=options.manifest_dir,
+        seed=options.random_seed,
+        rank=options.rank,
+        world_size=options.world_size,
+        sampler=options.sampler)
 
-image_shape = (96, 96, 3)
 if options.skip_training:
     number_of_batches = 1
 else:
-    number_of_batches = cell_data.number_of_images // options.batch_size
+    number_of_batches = cell_data.images_per_epoch // options.batch_size
 if options.conditional:
     # one-hot encode the compound and have a
     # continuous variable for the concentration.
@@ -184,7 +223,8 @@ if options.workspace is not None and options.frames_per_epoch:
         rate=common.Frequency(str(save_every)),
         sample=[np.random.randn(options.frame_sets, hyper.noise_size)],
         directory=options.frames_dir,
-        number_of_sets=options.frame_sets)
+        number_of_sets=options.frame_sets,
+        format=options.frame_format)
 else:
     frame_options = None
 
@@ -193,7 +233,10 @@ trainer_options = trainer.Options(
     summary_frequency=options.summary_freq,
     checkpoint_directory=options.checkpoint_dir,
     checkpoint_frequency=options.checkpoint_freq,
-    frame_options=frame_options)
+    frame_options=frame_options,
+    prefetch_depth=options.prefetch_batches,
+    asynchronous_checkpoints=options.async_checkpoints,
+    timing_file=options.timing_file)
 
 trainer = trainer.Trainer(options.epochs, number_of_batches,
                           options.batch_size, trainer_options)
@@ -202,14 +245,35 @@ if learning.decay:
     common.log_learning_rate_decay(options, learning, number_of_batches)
 
 with common.get_session(options.gpus, options.random_seed) as session:
-    model = Model(hyper, learning, session)
+    inputs = None
+    if options.input_pipeline and not options.skip_training:
+        inputs = pipeline.make_inputs(
+            cell_data,
+            options.batch_size,
+            image_shape,
+            number_of_threads=options.input_pipeline_threads)
+        model = Model(hyper, learning, session, inputs)
+    else:
+        model = Model(hyper, learning, session)
     log.info('\n%s', model)
+    if not options.skip_training and inputs is None:
+        # Checkpoint where we are in the data, so resumed runs continue there.
+        model.data_iterator = cell_data
+    elif inputs is not None:
+        # The pipeline reads rows well ahead of training, so the CellData
+        # position says little about which batches were trained on.
+        log.warning('Not checkpointing the data position with '
+                    '--input-pipeline: resumed runs restart the data order')
     if options.restore_from is None:
         tf.global_variables_initializer().run(session=session)
     else:
         model.restore(options.restore_from)
     if not options.skip_training:
-        trainer.train(model, cell_data.next_batch)
+        if inputs is None:
+            trainer.train(model, cell_data.next_batch)
+        else:
+            # The model pulls its batches from the pipeline by itself.
+            trainer.train(model, lambda _: None)
 
     if options.load_profiles:
         dataset = profiling.load_profiles(options.load_profiles, index=0)
@@ -360,7 +424,6 @@ with common.get_session(options.gpus, options.random_seed) as session:
                                  model.noise_size)
         if conditional_shape:
             labels = cell_data.sample_labels(options.interpolation_samples[0])
-            labels = np.array(list(labels))
             labels = labels.repeat(options.interpolation_samples[1], axis=0)
         else:
             labels = None
@@ -452,7 +515,7 @@ with common.get_session(options.gpus, options.random_seed) as session:
         # Fix two labels and sample random noise
         if conditional_shape:
             samples = [samples]
-            labels = np.array(list(cell_data.sample_labels(2)))
+            labels = cell_data.sample_labels(2)
             labels = labels.repeat(options.generative_samples // 2, axis=0)
             samples.append(labels)
 
@@ -465,7 +528,7 @@ with common.get_session(options.gpus, options.random_seed) as session:
         # Fix noise and sample many labels (should look very different?)
         if conditional_shape:
             labels = cell_data.sample_labels(options.generative_samples // 2)
-            labels = np.tile(np.array(list(labels)), (2, 1))
+            labels = np.tile(labels, (2, 1))
             noise = np.random.randn(2, model.noise_size)
             noise = np.repeat(noise, options.generative_samples // 2, axis=0)
             visualize.generative_samples(
@@ -483,5 +546,9 @@ with common.get_session(options.gpus, options.random_seed) as session:
             directory = os.path.join(options.figure_dir, 'generated')
             visualize.save_images(images, directory)
 
+if not options.skip_evaluation or options.load_cell_data:
+    if cell_data.image_cache is not None:
+        log.info('%s', cell_data.image_cache)
+
 if options.show_figures:
     visualize.show()
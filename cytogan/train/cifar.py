@@ -96,6 +96,9 @@ trainer.summary_directory = options.summary_dir
 trainer.summary_frequency = options.summary_freq
 trainer.checkpoint_directory = options.checkpoint_dir
 trainer.checkpoint_frequency = options.checkpoint_freq
+trainer.prefetch_depth = options.prefetch_batches
+trainer.asynchronous_checkpoints = options.async_checkpoints
+trainer.timing_file = options.timing_file
 with common.get_session(options.gpus, options.random_seed) as session:
     model = Model(hyper, learning, session)
     log.info('\n%s', model)
@@ -12,6 +12,7 @@ import tensorflow as tf
 
 from cytogan.extra import logs
 from cytogan import models
+from cytogan.train import frames
 
 log = logs.get_logger(__name__)
 
@@ -79,8 +80,11 @@ def make_parser(name):
     parser.add_argument(
         '--checkpoint-freq', type=Frequency, default=Frequency('30s'))
     parser.add_argument('--restore-from', metavar='CHECKPOINT_DIR')
+    parser.add_argument('--async-checkpoints', action='store_true')
     parser.add_argument('--frames-per-epoch', type=int)
     parser.add_argument('--frame-sets', type=int, default=4)
+    parser.add_argument('--frame-format', choices=frames.FORMATS, default='png')
+    parser.add_argument('--prefetch-batches', type=int, default=2)
     parser.add_argument('-w', '--workspace')
     parser.add_argument('-m', '--model', choices=models.MODELS, required=True)
     parser.add_argument('--dry', action='store_true')
@@ -99,6 +103,7 @@ def parse_args(parser):
     options.summary_dir = None
     options.figure_dir = None
     options.log_file = None
+    options.timing_file = None
     if options.workspace:
         timestamp = time.strftime('%d-%m-%Y_%H-%M-%S')
         run_name = '{0}_{1}'.format(options.model, timestamp)
@@ -110,6 +115,7 @@ def parse_args(parser):
         options.figure_dir = os.path.join(options.workspace, 'figures')
         options.frames_dir = os.path.join(options.workspace, 'frames')
         options.log_file = os.path.join(options.workspace, 'log.log')
+        options.timing_file = os.path.join(options.workspace, 'timing.jsonl')
 
     if options.model.startswith('c-'):
         options.model = options.model[2:]
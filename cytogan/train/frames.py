@@ -0,0 +1,105 @@
+import os
+import queue
+import threading
+
+import h5py
+import numpy as np
+import scipy.misc
+
+from cytogan.extra import logs
+
+log = logs.get_logger(__name__)
+
+FORMATS = ('png', 'h5')
+# Name of the frame dataset inside every {set}.h5 file.
+H5_DATASET = 'frames'
+
+
+def read_h5_frames(path):
+    with h5py.File(path, 'r') as frame_file:
+        return frame_file[H5_DATASET][:]
+
+
+class FrameWriter(object):
+    '''
+    Writes frames of generated images on a background thread. Each of the
+    number_of_sets sets either is a directory of {index}.png images, or a
+    single (gzip compressed) {set}.h5 file whose frame dataset grows by one
+    image per frame.
+    '''
+
+    def __init__(self, directory, number_of_sets, frame_format='png'):
+        assert frame_format in FORMATS, frame_format
+        self.directory = directory
+        self.number_of_sets = number_of_sets
+        self.frame_format = frame_format
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # We only look at what is on disk once, then keep count ourselves.
+        self.counts = [self._count_frames(i) for i in range(number_of_sets)]
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_frames, daemon=True)
+        self.thread.start()
+
+    def write(self, frames):
+        '''Queues one uint8 frame for each set.'''
+        assert len(frames) >= self.number_of_sets, len(frames)
+        indices = list(self.counts)
+        self.counts = [count + 1 for count in self.counts]
+        self.queue.put((frames[:self.number_of_sets], indices))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _count_frames(self, set_index):
+        path = self._get_path(set_index)
+        if self.frame_format == 'png':
+            if not os.path.exists(path):
+                os.makedirs(path)
+                return 0
+            return len(os.listdir(path))
+        if not os.path.exists(path):
+            return 0
+        with h5py.File(path, 'r') as frame_file:
+            return len(frame_file[H5_DATASET])
+
+    def _get_path(self, set_index):
+        if self.frame_format == 'png':
+            return os.path.join(self.directory, str(set_index))
+        return os.path.join(self.directory, '{0}.h5'.format(set_index))
+
+    def _write_frames(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            frames, indices = item
+            for set_index, (frame, index) in enumerate(zip(frames, indices)):
+                try:
+                    if self.frame_format == 'png':
+                        self._write_png(set_index, frame, index)
+                    else:
+                        self._append_h5(set_index, frame)
+                except Exception:
+                    log.exception('Could not write frame %d of set %d', index,
+                                  set_index)
+
+    def _write_png(self, set_index, frame, index):
+        filename = '{0}.png'.format(index)
+        path = os.path.join(self._get_path(set_index), filename)
+        scipy.misc.imsave(path, frame.squeeze())
+
+    def _append_h5(self, set_index, frame):
+        with h5py.File(self._get_path(set_index), 'a') as frame_file:
+            if H5_DATASET not in frame_file:
+                frame_file.create_dataset(
+                    H5_DATASET,
+                    shape=(0, ) + frame.shape,
+                    maxshape=(None, ) + frame.shape,
+                    chunks=(1, ) + frame.shape,
+                    dtype=np.uint8,
+                    compression='gzip')
+            dataset = frame_file[H5_DATASET]
+            dataset.resize(len(dataset) + 1, axis=0)
+            dataset[-1] = frame
@@ -143,7 +143,8 @@ if options.workspace is not None and options.frames_per_epoch:
         rate=common.Frequency(str(save_every)),
         sample=[np.random.randn(options.frame_sets, hyper.noise_size)],
         directory=options.frames_dir,
-        number_of_sets=options.frame_sets)
+        number_of_sets=options.frame_sets,
+        format=options.frame_format)
 else:
     frame_options = None
 
@@ -152,7 +153,10 @@ trainer_options = trainer.Options(
     summary_frequency=options.summary_freq,
     checkpoint_directory=options.checkpoint_dir,
     checkpoint_frequency=options.checkpoint_freq,
-    frame_options=frame_options)
+    frame_options=frame_options,
+    prefetch_depth=options.prefetch_batches,
+    asynchronous_checkpoints=options.async_checkpoints,
+    timing_file=options.timing_file)
 
 trainer = trainer.Trainer(options.epochs, number_of_batches,
                           options.batch_size, trainer_options)
@@ -1,20 +1,24 @@
 import collections
+import json
 import os
+import queue
+import threading
 import time
 
 import numpy as np
-import scipy.misc
 import tensorflow as tf
 import tqdm
 
 from cytogan.extra import logs
 from cytogan.extra.misc import namedtuple
+from cytogan.train.frames import FrameWriter
 
 FrameOptions = namedtuple('FrameOptions', [
     'rate',
     'sample',
     'directory',
     'number_of_sets',
+    'format',
 ])
 
 Options = namedtuple('TrainerOptions', [
@@ -23,6 +27,9 @@ Options = namedtuple('TrainerOptions', [
     'checkpoint_directory',
     'checkpoint_frequency',
     'frame_options',
+    'prefetch_depth',
+    'asynchronous_checkpoints',
+    'timing_file',
 ])
 
 # Supress warnings about wrong compilation of TensorFlow.
@@ -31,6 +38,70 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 log = logs.get_logger(__name__)
 
 
+class BatchPrefetcher(object):
+    '''
+    Calls a batch generator on a background thread and keeps up to depth
+    batches ready in a bounded queue. Behaves like the batch generator itself.
+
+    Batches must not change once handed out, so generators returning views
+    into buffers they later modify have to copy them.
+
+    With a data_iterator (like CellData), its state is taken right after each
+    batch is produced and queued along with it. get_state() then returns the
+    state after the last batch handed out, rather than the state of the
+    data_iterator, which runs ahead by up to depth batches.
+    '''
+
+    def __init__(self, batch_generator, batch_size, depth,
+                 data_iterator=None):
+        assert depth > 0, depth
+        self.batch_generator = batch_generator
+        self.batch_size = batch_size
+        self.data_iterator = data_iterator
+        self.state = None
+        if data_iterator is not None:
+            self.state = data_iterator.get_state()
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def __call__(self, batch_size):
+        assert batch_size == self.batch_size, batch_size
+        batch, state, error = self.queue.get()
+        if error is not None:
+            raise error
+        self.state = state
+        return batch
+
+    def get_state(self):
+        return self.state
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _fill(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = self.batch_generator(self.batch_size)
+                state = None
+                if self.data_iterator is not None:
+                    state = self.data_iterator.get_state()
+                item = batch, state, None
+            except Exception as error:
+                # Re-raised in the training thread.
+                item = None, None, error
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[2] is not None:
+                return
+
+
 class Trainer(object):
     def __init__(self,
                  number_of_epochs,
@@ -44,44 +115,106 @@ class Trainer(object):
         for index, field in enumerate(options._fields):
             setattr(self, field, options[index])
         self.summary_writer = None
+        self.frame_writer = None
 
     def train(self, model, batch_generator):
         if self.summary_directory is not None:
             self.summary_writer = self._get_summary_writer(model.graph)
 
+        if self.frame_options is not None:
+            self.frame_writer = FrameWriter(
+                self.frame_options.directory,
+                self.frame_options.number_of_sets,
+                self.frame_options.format or 'png')
+
         start_time = time.time()
         try:
             self._train_loop(model, batch_generator)
         except KeyboardInterrupt:
             print()
+        finally:
+            if self.frame_writer is not None:
+                self.frame_writer.close()
         elapsed_time = time.time() - start_time
 
         if self.checkpoint_directory is not None:
-            model.save(self.checkpoint_directory)
+            # Use the same saver as during training, so that it keeps track of
+            # all checkpoints, but don't leave before the files are written.
+            model.wait_for_checkpoint()
+            model.save(self.checkpoint_directory,
+                       self.asynchronous_checkpoints)
+            model.wait_for_checkpoint()
 
         log.info('Training complete! Took %.2fs', elapsed_time)
 
     def _train_loop(self, model, batch_generator):
-        log_file = logs.LogFile(logs.get_raw_logger(__name__))
+        if self.prefetch_depth:
+            data_iterator = model.data_iterator
+            prefetcher = BatchPrefetcher(batch_generator, self.batch_size,
+                                         self.prefetch_depth, data_iterator)
+            # Checkpoints record the position after the batches we trained
+            # on, not after the ones we prefetched.
+            if data_iterator is not None:
+                model.data_iterator = prefetcher
+            try:
+                self._train_epochs(model, prefetcher)
+            finally:
+                prefetcher.close()
+                if data_iterator is not None:
+                    # Rewind past the prefetched batches nobody trained on.
+                    data_iterator.set_state(prefetcher.get_state())
+                    model.data_iterator = data_iterator
+        else:
+            self._train_epochs(model, batch_generator)
+
+    def _train_epochs(self, model, batch_generator):
+        # The progress bar refreshes far more often than is worth writing to
+        # the log files, but the console should still see all of it.
+        log_file = logs.LogFile(
+            logs.get_raw_logger(__name__, file_min_interval=1.0))
+        timer = model.timer
         number_of_iterations = 0
         for epoch_index in range(1, self.number_of_epochs + 1):
             batch_range = self._get_batch_range(log_file, epoch_index)
             for _ in batch_range:
-                batch = batch_generator(self.batch_size)
-                if self._is_time_to_write_summary(number_of_iterations):
-                    current_loss, summary = model.train_on_batch(
-                        batch, with_summary=True)
-                    if summary is not None:
-                        self.summary_writer.add_summary(summary, model.step)
-                else:
-                    current_loss = model.train_on_batch(batch)
+                with timer.phase('data_wait'):
+                    batch = batch_generator(self.batch_size)
+                # Everything we report comes out of the step's own runs.
+                with_summary = self._is_time_to_write_summary(
+                    number_of_iterations)
+                metrics = model.train_on_batch(batch, with_summary)
+                if metrics.summary is not None:
+                    with timer.phase('summary'):
+                        self.summary_writer.add_summary(
+                            metrics.summary, metrics.step)
                 if self._is_time_to_save_checkpoint(number_of_iterations):
-                    model.save(self.checkpoint_directory)
+                    with timer.phase('checkpoint'):
+                        model.save(self.checkpoint_directory,
+                                   self.asynchronous_checkpoints)
                 if self._is_time_to_generate_frame(number_of_iterations):
-                    self._generate_frame(model)
-                self._update_progressbar(batch_range, model.learning_rate,
-                                         current_loss)
+                    with timer.phase('frame'):
+                        self._generate_frame(model)
+                timer.end_step()
+                self._update_progressbar(batch_range, metrics.learning_rate,
+                                         metrics.loss)
                 number_of_iterations += 1
+            self._write_timing(timer.end_epoch(), epoch_index, model.step)
+
+    def _write_timing(self, timing, epoch_index, step):
+        stall_time = timing.get('data_wait', {}).get('total', 0)
+        log.info('Epoch %d: waited %.2fs for batches', epoch_index,
+                 stall_time)
+        if self.summary_writer is not None:
+            summary = tf.Summary()
+            for phase, stats in sorted(timing.items()):
+                for key in ('p50', 'p95', 'p99'):
+                    tag = 'timing/{0}/{1}'.format(phase, key)
+                    summary.value.add(tag=tag, simple_value=stats[key])
+            self.summary_writer.add_summary(summary, step)
+        if self.timing_file is not None:
+            record = dict(epoch=epoch_index, step=int(step), phases=timing)
+            with open(self.timing_file, 'a') as timing_file:
+                timing_file.write(json.dumps(record, sort_keys=True) + '\n')
 
     def _is_time_to_write_summary(self, number_of_iterations):
         if self.summary_writer is not None:
@@ -126,17 +259,8 @@ class Trainer(object):
     def _generate_frame(self, model):
         assert model.is_generative, model.name + ' is not generative'
         frames = model.generate(*self.frame_options.sample)
-        if not os.path.exists(self.frame_options.directory):
-            os.makedirs(self.frame_options.directory)
-            for i in range(self.frame_options.number_of_sets):
-                os.makedirs(os.path.join(self.frame_options.directory, str(i)))
         frames = (frames * 255).astype(np.uint8)
-        for i in range(self.frame_options.number_of_sets):
-            directory = os.path.join(self.frame_options.directory, str(i))
-            index = len(os.listdir(directory))
-            filename = '{0}.png'.format(index)
-            path = os.path.join(directory, filename)
-            scipy.misc.imsave(path, frames[i].squeeze())
+        self.frame_writer.write(frames)
 
     def __repr__(self):
         return 'Trainer<{0} epochs x {1} batches @ {2} examples>'.format(
@@ -2,65 +2,98 @@
 
 import argparse
 import os
+import shutil
 import subprocess
+import tempfile
 import numpy as np
 import scipy.misc
 import tqdm
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-o', '--output', default='animated.gif')
-parser.add_argument('-r', '--skip-rate', type=int, default=1)
-parser.add_argument('-d', '--delay', type=int, default=10)
-parser.add_argument('-a', '--annotate', nargs='+')
-parser.add_argument('--frames-per-annotation', type=int, default=1)
-parser.add_argument('--annotation-height', type=int)
-parser.add_argument('--annotated-path')
-parser.add_argument('-v', '--verbose', action='store_true')
-parser.add_argument('files', nargs='+')
-options = parser.parse_args()
 
-options.files.sort(key=lambda p: int(os.path.basename(p).split('.')[0]))
+def unpack_frames(path):
+    # Only needed for HDF5 frames, so that PNG frames need neither h5py nor
+    # cytogan on the path.
+    from cytogan.train.frames import read_h5_frames
+
+    # convert wants images, so unpack the frame file into numbered PNGs.
+    frames = read_h5_frames(path)
+    frame_directory = tempfile.mkdtemp(prefix='frames-')
+    files = []
+    for index, frame in enumerate(tqdm.tqdm(frames, desc='Unpacking frames')):
+        frame_path = os.path.join(frame_directory, f'{index}.png')
+        scipy.misc.imsave(frame_path, frame.squeeze())
+        files.append(frame_path)
+    return frame_directory, files
+
+
+def make_gif(options):
+    options.files.sort(key=lambda p: int(os.path.basename(p).split('.')[0]))
 
-if options.annotate is not None:
-    if options.annotated_path is None:
-        options.annotated_path = os.path.join(
-            os.path.dirname(options.files[0]), 'annotated')
-    if not os.path.exists(options.annotated_path):
-        os.makedirs(options.annotated_path)
+    if options.annotate is not None:
+        if options.annotated_path is None:
+            options.annotated_path = os.path.join(
+                os.path.dirname(options.files[0]), 'annotated')
+        if not os.path.exists(options.annotated_path):
+            os.makedirs(options.annotated_path)
 
-    annotations = np.repeat(options.annotate, options.frames_per_annotation)
+        annotations = np.repeat(options.annotate,
+                                options.frames_per_annotation)
 
-    height, width = scipy.misc.imread(options.files[0]).shape[:2]
-    print(f'Assuming dimensions {height}x{width} for images')
+        height, width = scipy.misc.imread(options.files[0]).shape[:2]
+        print(f'Assuming dimensions {height}x{width} for images')
 
-    if options.annotation_height is None:
-        options.annotation_height = int(1 / 6 * height)
+        if options.annotation_height is None:
+            options.annotation_height = int(1 / 6 * height)
 
-    generator = tqdm.tqdm(
-        enumerate(zip(options.files, annotations)),
-        unit=' images',
-        desc='Annotating images')
+        generator = tqdm.tqdm(
+            enumerate(zip(options.files, annotations)),
+            unit=' images',
+            desc='Annotating images')
 
-    for n, (file, annotation) in generator:
-        new_path = os.path.join(options.annotated_path, os.path.basename(file))
+        for n, (file, annotation) in generator:
+            new_path = os.path.join(options.annotated_path,
+                                    os.path.basename(file))
 
-        command = f'convert {file} '.split()
-        command += f'-size {width}x{options.annotation_height} '.split()
-        command += f'-background Black -fill white -gravity south-west '.split()
-        command += [f'caption:{annotation}']
-        command += f'-composite {new_path}'.split()
-        subprocess.run(command, check=True)
+            command = f'convert {file} '.split()
+            command += f'-size {width}x{options.annotation_height} '.split()
+            command += '-background Black -fill white '.split()
+            command += '-gravity south-west '.split()
+            command += [f'caption:{annotation}']
+            command += f'-composite {new_path}'.split()
+            subprocess.run(command, check=True)
 
-        # Replace the path with the annotated path
-        options.files[n] = new_path
+            # Replace the path with the annotated path
+            options.files[n] = new_path
 
-files = options.files[::options.skip_rate]
-files = ' '.join(files)
+    files = options.files[::options.skip_rate]
+    files = ' '.join(files)
 
-command = 'convert -background white -alpha remove -duplicate 1,-2-1 '
-command += f'-loop 0 -delay {options.delay} '
-command += f'{files} {options.output}'
+    command = 'convert -background white -alpha remove -duplicate 1,-2-1 '
+    command += f'-loop 0 -delay {options.delay} '
+    command += f'{files} {options.output}'
+
+    if options.verbose:
+        print(command)
+    subprocess.run(command.split(), check=True)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-o', '--output', default='animated.gif')
+parser.add_argument('-r', '--skip-rate', type=int, default=1)
+parser.add_argument('-d', '--delay', type=int, default=10)
+parser.add_argument('-a', '--annotate', nargs='+')
+parser.add_argument('--frames-per-annotation', type=int, default=1)
+parser.add_argument('--annotation-height', type=int)
+parser.add_argument('--annotated-path')
+parser.add_argument('-v', '--verbose', action='store_true')
+parser.add_argument('files', nargs='+', help='PNG frames or one .h5 file')
+options = parser.parse_args()
 
-if options.verbose:
-    print(command)
-subprocess.run(command.split(), check=True)
+frame_directory = None
+if len(options.files) == 1 and options.files[0].endswith('.h5'):
+    frame_directory, options.files = unpack_frames(options.files[0])
+try:
+    make_gif(options)
+finally:
+    if frame_directory is not None:
+        shutil.rmtree(frame_directory)
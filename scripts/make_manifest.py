@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import argparse
+import os.path
+import re
+import time
+
+import pandas as pd
+
+from cytogan.data import manifest
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='make-manifest')
+    parser.add_argument('--metadata', required=True)
+    parser.add_argument('--image-path', required=True)
+    parser.add_argument('--manifest-dir', default=manifest.DEFAULT_DIRECTORY)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('-p', '--pattern', action='append')
+    return parser.parse_args()
+
+
+def main():
+    options = parse()
+    metadata = pd.read_csv(options.metadata)
+    plate_names = list(metadata['Image_Metadata_Plate_DAPI'])
+    file_names = [
+        os.path.splitext(name)[0] for name in metadata['Image_FileName_DAPI']
+    ]
+    patterns = None
+    if options.pattern:
+        patterns = [re.compile(pattern) for pattern in options.pattern]
+
+    start = time.time()
+    root_path = os.path.realpath(options.image_path)
+    # Taken before scanning, so that changes during the scan make it stale.
+    mtimes = manifest.directory_mtimes(root_path, plate_names)
+    indices, keys = manifest.scan_single_cell_names(
+        root_path, plate_names, file_names, patterns, options.workers)
+    signature = manifest.metadata_signature(plate_names, file_names, patterns)
+    path = manifest.manifest_path(options.manifest_dir, root_path)
+    manifest.save(path, root_path, signature, mtimes, indices, keys)
+
+    elapsed = time.time() - start
+    print('Stored {0:,} cells in {1} in {2:.2f}s'.format(
+        len(keys), path, elapsed))
+
+
+if __name__ == '__main__':
+    main()
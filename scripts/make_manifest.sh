@@ -0,0 +1,4 @@
+#!/bin/bash
+python3 -m scripts.make_manifest                        \
+  --metadata /data1/peter/metadata/BBBC021_v1_image.csv \
+  --image-path /data1/peter/segmented
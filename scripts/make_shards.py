@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import time
+
+import scipy.misc
+import tqdm
+
+from cytogan.data import shards
+
+
+def cell_sort_key(key):
+    # Sort by image prefix, then numerically by cell number, so that the cells
+    # of one image sit next to each other within a shard.
+    prefix, _, number = key.rpartition('-')
+    return prefix, int(number) if number.isdigit() else number
+
+
+def find_cells(image_path, extension):
+    keys = []
+    for directory, _, filenames in os.walk(image_path):
+        directory = os.path.relpath(directory, start=image_path)
+        for filename in filenames:
+            if filename.endswith(extension):
+                name = os.path.splitext(filename)[0]
+                keys.append(os.path.normpath(os.path.join(directory, name)))
+    return sorted(keys, key=cell_sort_key)
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='make-shards')
+    parser.add_argument('-i', '--image-path', required=True)
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--cells-per-shard', type=int, default=100000)
+    parser.add_argument('--extension', default='.png')
+    return parser.parse_args()
+
+
+def main():
+    options = parse()
+    start = time.time()
+    keys = find_cells(options.image_path, options.extension)
+    print('Found {0:,} cells under {1}'.format(len(keys), options.image_path))
+    if not keys:
+        return
+
+    writer = None
+    try:
+        for key in tqdm.tqdm(keys, unit=' cells'):
+            path = os.path.join(options.image_path, key + options.extension)
+            image = scipy.misc.imread(path)
+            if image.ndim == 2:
+                image = image.reshape(image.shape + (1, ))
+            if writer is None:
+                writer = shards.ShardWriter(options.output, image.shape,
+                                            options.cells_per_shard)
+            writer.append(key, image)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    elapsed = time.time() - start
+    print('Packed {0:,} cells into {1} in {2:.2f}s'.format(
+        len(keys), options.output, elapsed))
+
+
+if __name__ == '__main__':
+    main()
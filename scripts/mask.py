@@ -9,22 +9,32 @@ from builtins import open
 from future import standard_library
 standard_library.install_aliases()
 import argparse
+import csv
 import glob
 import multiprocessing
+import multiprocessing.util
 import os
 import os.path
 import signal
+import threading
 import time
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import matplotlib.pyplot as plot
 import numpy as np
 import pandas as pd
 import scipy.misc
+import scipy.ndimage
+
+from cytogan.data import shards
 
 ImagePath = namedtuple('ImagePath', 'dna, tubulin, actin, mask, prefix')
 Image = namedtuple('Image', 'dna, tubulin, actin, mask')
 
+OUTPUT_FORMATS = ('png', 'shards')
+# With --output-format shards, the index also says where each cell came from.
+SHARD_INDEX_COLUMNS = shards.INDEX_COLUMNS + ['plate', 'image', 'cell']
+
 
 def filter_metadata(metadata, patterns):
     regex_pattern = '|'.join(patterns)
@@ -77,51 +87,21 @@ def read_images(image_path):
     return Image(dna_image, tubulin_image, actin_image, mask_image)
 
 
-def get_crop_slices(minima, maxima, mask_index):
-    mask_min_row = minima.row[mask_index] + 1
-    mask_max_row = maxima.row[mask_index] + 1
-    mask_min_column = minima.column[mask_index]
-    mask_max_column = maxima.column[mask_index]
-    row_slice = slice(mask_min_row, mask_max_row)
-    column_slice = slice(mask_min_column, mask_max_column)
-
-    return row_slice, column_slice
-
-
-def crop_channel(row_slice, column_slice, image, mask, output_size):
-    width = row_slice.stop - row_slice.start
-    height = column_slice.stop - column_slice.start
-
-    row_start = max(0, (output_size - width) // 2)
-    row_end = row_start + width
-    column_start = max(0, (output_size - height) // 2)
-    column_end = column_start + height
-
-    cropped_image = np.zeros((output_size, output_size))
-    image_crop = image[row_slice, column_slice]
-    cropped_image[row_start:row_end, column_start:column_end] = image_crop
-
-    cropped_mask = np.zeros_like(cropped_image)
-    mask_crop = mask[row_slice, column_slice]
-    cropped_mask[row_start:row_end, column_start:column_end] = mask_crop
-
-    return cropped_image, cropped_mask
-
-
-def get_mask_boundaries(image, mask):
-    row, col = np.indices(mask.shape)
-    row, col = row.flatten(), col.flatten()
-
-    index = pd.MultiIndex.from_arrays([mask.flatten()], names=['label'])
-
-    row_series = pd.Series(row, index=index, name='row')
-    col_series = pd.Series(col, index=index, name='column')
-    image_series = pd.Series(image.flatten(), index=index, name='image')
-    columns = pd.concat([row_series, col_series, image_series], axis=1)
-
-    # Aggregate over the pixel values of the mask.
-    grouped = columns.groupby(level=0)
-    return grouped.min(), grouped.max()
+def get_cell_slices(mask):
+    '''
+    Yields the label and (row, column) crop slices of every label present in
+    the mask, computing all bounding boxes in one pass. Like the bounding
+    boxes of the mask, rows start one below and columns end one before it.
+    '''
+    # find_objects skips label 0, but the background is a "cell" too.
+    objects = scipy.ndimage.find_objects(mask.astype(np.int32) + 1)
+    for label, bounding_box in enumerate(objects):
+        if bounding_box is None:
+            continue
+        rows, columns = bounding_box
+        row_slice = slice(rows.start + 1, rows.stop)
+        column_slice = slice(columns.start, columns.stop - 1)
+        yield label, row_slice, column_slice
 
 
 def clip_crop_slices(slices, clip):
@@ -132,20 +112,33 @@ def clip_crop_slices(slices, clip):
     return output
 
 
-def process_channel(image, mask, output_size):
-    minima, maxima = get_mask_boundaries(image, mask)
-    # The first mask is the entire segmentation
-    for mask_index in minima.index.values:
-        slices = get_crop_slices(minima, maxima, mask_index)
-        row_slice, column_slice = clip_crop_slices(slices, output_size)
-        crops = crop_channel(row_slice, column_slice, image, mask, output_size)
-        cropped_image, cropped_mask = crops
+def get_crop_offset(crop_slice, output_size):
+    # Where the crop starts so that it is centered in the output.
+    return max(0, (output_size - (crop_slice.stop - crop_slice.start)) // 2)
+
+
+def segment_cells(image, output_size):
+    '''
+    Returns a (cells, output_size, output_size, 3) uint8 array with the dna,
+    tubulin and actin channels of every cell in the mask, centered and with
+    all pixels outside the cell zeroed.
+    '''
+    cell_slices = list(get_cell_slices(image.mask))
+    channels = np.stack([image.dna, image.tubulin, image.actin], axis=-1)
+    cells = np.zeros((len(cell_slices), output_size, output_size, 3), np.uint8)
+    for cell, (label, row_slice, column_slice) in zip(cells, cell_slices):
+        row_slice, column_slice = clip_crop_slices([row_slice, column_slice],
+                                                   output_size)
+        row_start = get_crop_offset(row_slice, output_size)
+        column_start = get_crop_offset(column_slice, output_size)
+        crop = channels[row_slice, column_slice]
+        cell_pixels = image.mask[row_slice, column_slice] == label
+        target = cell[row_start:row_start + crop.shape[0],
+                      column_start:column_start + crop.shape[1]]
+        # Truncates to uint8 just like astype().
+        target[cell_pixels] = crop[cell_pixels]
 
-        masked_image = np.zeros_like(cropped_image)
-        mask_indices = np.where(cropped_mask == mask_index)
-        masked_image[mask_indices] = cropped_image[mask_indices]
-
-        yield masked_image
+    return cells
 
 
 def display_cell(dna, tubulin, actin, cell):
@@ -160,17 +153,11 @@ def display_cell(dna, tubulin, actin, cell):
 
 
 def process_image(image, output_size, display):
-    dna_masked = process_channel(image.dna, image.mask, output_size)
-    actin_masked = process_channel(image.actin, image.mask, output_size)
-    tubulin_masked = process_channel(image.tubulin, image.mask, output_size)
-
-    cells = []
-    for dna, actin, tubulin in zip(dna_masked, actin_masked, tubulin_masked):
-        cell = np.dstack([dna, tubulin, actin]).astype(np.uint8)
-        assert np.ndim(cell) == 3
-        if display:
+    cells = segment_cells(image, output_size)
+    if display:
+        for cell in cells:
+            dna, tubulin, actin = np.rollaxis(cell, 2)
             display_cell(dna, tubulin, actin, cell)
-        cells.append(cell)
 
     return cells
 
@@ -180,47 +167,215 @@ def save_single_cell(output_directory, image_prefix, index, image):
     output_path = os.path.join(output_directory, filename)
     most_specific_directory = os.path.dirname(output_path)
     if not os.path.exists(most_specific_directory):
-        os.makedirs(most_specific_directory)
-        print('Creating {0}'.format(most_specific_directory))
+        try:
+            os.makedirs(most_specific_directory)
+            print('Creating {0}'.format(most_specific_directory))
+        except OSError:
+            # Another worker got there first.
+            if not os.path.isdir(most_specific_directory):
+                raise
     assert np.ndim(image) == 3
     scipy.misc.imsave(output_path, image)
 
 
+class Ledger(object):
+    '''
+    Append-only record of the images whose cells were written, as
+    key,number_of_cells,location,complete lines. Images that got fewer cells
+    than they have (because of the cell limit) are recorded as partial, and
+    only complete images count as done. If given a cell count CSV, keeps it
+    up to date with the complete images after every image, so that partial
+    results can be used while (or after) a run fails.
+    '''
+
+    HEADER = 'key,number_of_cells,location,complete\n'
+
+    def __init__(self, path, cell_count_path=None):
+        self.cell_counts = OrderedDict()
+        # Images whose cells were only partially written, to be redone.
+        self.partial_images = set()
+        if os.path.exists(path):
+            self._read(path)
+        else:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+        self.file = open(path, 'a')
+        if not self.cell_counts and self.file.tell() == 0:
+            self.file.write(self.HEADER)
+            self.file.flush()
+
+        self.cell_count_file = None
+        if cell_count_path:
+            # Rewritten from the ledger, so that it never has duplicates.
+            # Keys are quoted as needed, in case they contain commas.
+            self.cell_count_file = open(cell_count_path, 'w', newline='')
+            self.cell_count_writer = csv.writer(
+                self.cell_count_file, lineterminator='\n')
+            self.cell_count_file.write('key, number_of_cells\n')
+            self.cell_count_writer.writerows(self.cell_counts.items())
+            self.cell_count_file.flush()
+
+    def __contains__(self, image_key):
+        return image_key in self.cell_counts
+
+    def __len__(self):
+        return len(self.cell_counts)
+
+    @property
+    def number_of_cells(self):
+        return sum(self.cell_counts.values())
+
+    def append(self, image_key, count, location, complete=True):
+        # One write per line, so that a crash leaves at most one partial line.
+        line = '{0},{1},{2},{3:d}\n'.format(image_key, count, location,
+                                            complete)
+        self.file.write(line)
+        self.file.flush()
+        if not complete:
+            self.partial_images.add(image_key)
+            return
+        if self.cell_count_file is not None:
+            self.cell_count_writer.writerow([image_key, count])
+            self.cell_count_file.flush()
+        self.cell_counts[image_key] = count
+        self.partial_images.discard(image_key)
+
+    def close(self):
+        self.file.close()
+        if self.cell_count_file is not None:
+            self.cell_count_file.close()
+
+    def _read(self, path):
+        with open(path, 'rb') as ledger_file:
+            content = ledger_file.read()
+        # Drop a partial last line left behind by a crash.
+        complete = content[:content.rfind(b'\n') + 1]
+        if len(complete) < len(content):
+            with open(path, 'rb+') as ledger_file:
+                ledger_file.truncate(len(complete))
+        for line in complete.decode().splitlines()[1:]:
+            image_key, count, _, is_complete = line.rsplit(',', 3)
+            if int(is_complete):
+                self.cell_counts[image_key] = int(count)
+                self.partial_images.discard(image_key)
+            else:
+                self.partial_images.add(image_key)
+
+
+# Number of cells written by all workers, shared through the pool initializer.
+_cells_written = None
+# The shards of a worker (with --output-format shards).
+_shard_writer = None
+
+
+def _initialize_worker(cells_written):
+    global _cells_written
+    _cells_written = cells_written
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Runs as the worker exits after pool.close(), so that no shard is left
+    # open (and unflushed) behind the index.
+    multiprocessing.util.Finalize(None, _close_shard_writer, exitpriority=10)
+
+
+def _close_shard_writer():
+    global _shard_writer
+    if _shard_writer is not None:
+        _shard_writer.close()
+        _shard_writer = None
+
+
+def _reserve_cells(number_of_cells, cell_limit):
+    # How many of number_of_cells we may still write without going over the
+    # cell limit of the entire run.
+    with _cells_written.get_lock():
+        if cell_limit is not None:
+            remaining = max(0, cell_limit - _cells_written.value)
+            number_of_cells = min(number_of_cells, remaining)
+        _cells_written.value += number_of_cells
+    return number_of_cells
+
+
+def _release_cells(number_of_cells):
+    # Gives back cells reserved for an image that failed.
+    with _cells_written.get_lock():
+        _cells_written.value -= number_of_cells
+
+
 class MaskJob(object):
+    '''
+    Segments and writes the cells of one image in a worker process. Only the
+    image key, number of cells written and where they went go back to the
+    parent.
+    '''
+
     def __init__(self, options):
         self.options = options
         self.images_processed = 0
         self.cells_processed = 0
         self.error_count = 0
-        self.cell_counts = {}
+        self.images_skipped = 0
 
     def __call__(self, image_index, image_path):
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
         image_key = image_path.prefix
-        image = read_images(image_path)
+        count = 0
         try:
+            image = read_images(image_path)
             cells = process_image(image, self.options.size,
                                   self.options.display)
+            assert np.ndim(cells) == 4 and cells.shape[3] == 3, cells.shape
+            count = _reserve_cells(len(cells), self.options.cell_limit)
+            location, index_rows = None, None
+            if self.options.display:
+                pass
+            elif self.options.output_format == 'shards':
+                location, index_rows = self._write_shards(
+                    image_key, cells[:count])
+            else:
+                location = os.path.join(self.options.output,
+                                        os.path.dirname(image_key))
+                for cell_index, cell in enumerate(cells[:count]):
+                    save_single_cell(self.options.output, image_key,
+                                     cell_index, cell)
         except Exception as error:
+            # The image isn't indexed or recorded as done, so its cells
+            # don't count towards the limit.
+            _release_cells(count)
             raise RuntimeError(image_key, error)
-        return image_key, cells
+        return image_key, count, len(cells), location, index_rows
+
+    def _write_shards(self, image_key, cells):
+        global _shard_writer
+        if _shard_writer is None:
+            # Every worker appends to shards of its own, but only the parent
+            # writes the index.
+            _shard_writer = shards.ShardWriter(
+                self.options.output,
+                cells.shape[1:],
+                self.options.cells_per_shard,
+                prefix='cells-{0}'.format(os.getpid()),
+                write_index=False)
+        plate, image_name = os.path.split(image_key)
+        index_rows, shard_names = [], []
+        for cell_index, cell in enumerate(cells):
+            cell_key = '{0}-{1}'.format(image_key, cell_index)
+            row = _shard_writer.append(cell_key, cell)
+            index_rows.append(row + (plate, image_name, cell_index))
+            if row[1] not in shard_names:
+                shard_names.append(row[1])
+        # The parent indexes the cells as soon as we return.
+        _shard_writer.flush()
+        return ';'.join(shard_names), index_rows
 
     def on_success(self, args):
-        image_key, cells = args
-        # Count the difference so we know when cells_processed is > limit
-        cells_at_start = self.cells_processed
-        for cell_index, cell in enumerate(cells):
-            assert np.ndim(cell) == 3
-            assert cell.shape[2] == 3
-            if not self.options.display:
-                save_single_cell(self.options.output, image_key, cell_index,
-                                 cell)
-            self.cells_processed += 1
-            if self.cells_processed == self.options.cell_limit:
-                break
-        count = self.cells_processed - cells_at_start
-        print('Generated {0:>3} cells for {1} ...'.format(count, image_key))
-        self.cell_counts[image_key] = count
+        image_key, count, number_of_cells, _, _ = args
+        if count < number_of_cells:
+            print('Generated {0:>3} of {1} cells for {2} ...'.format(
+                count, number_of_cells, image_key))
+        else:
+            print('Generated {0:>3} cells for {1} ...'.format(
+                count, image_key))
+        self.cells_processed += count
         self.images_processed += 1
 
     def on_error(self, error):
@@ -229,25 +384,73 @@ class MaskJob(object):
         print('Failed to process {0}: {1}'.format(image_key, repr(real_error)))
 
 
-def mask_images(image_paths, options):
+def mask_images(image_paths, options, ledger=None):
     job = MaskJob(options)
-    pool = multiprocessing.Pool()
+    # Images and cells completed by earlier runs count towards the limits.
+    images_done = len(ledger) if ledger is not None else 0
+    cells_done = ledger.number_of_cells if ledger is not None else 0
+    cells_written = multiprocessing.Value('l', cells_done)
+    pool = multiprocessing.Pool(
+        initializer=_initialize_worker, initargs=[cells_written])
+    # Bounds the images queued or being processed, so we read the metadata
+    # (and hold results) no faster than the workers get through them.
+    max_in_flight = options.max_in_flight or 2 * multiprocessing.cpu_count()
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def release(function):
+        def callback(args):
+            try:
+                function(args)
+            finally:
+                in_flight.release()
+
+        return callback
+
+    index_file = None
+    if options.output_format == 'shards' and not options.display:
+        shape = (options.size, options.size, 3)
+        shards.write_image_shape(options.output, shape)
+        index_file = shards.open_index(options.output, SHARD_INDEX_COLUMNS)
+
+    def on_success(args):
+        job.on_success(args)
+        image_key, count, number_of_cells, location, index_rows = args
+        # Index before the ledger, so that every completed image is indexed.
+        if index_rows:
+            lines = [','.join(map(str, row)) + '\n' for row in index_rows]
+            index_file.write(''.join(lines))
+            index_file.flush()
+        # The job is pickled for every image, so it can't hold the ledger.
+        # Images cut short by the cell limit are redone by the next run.
+        if ledger is not None:
+            ledger.append(image_key, count, location,
+                          count == number_of_cells)
+
     try:
         for image_index, image_path in enumerate(image_paths):
-            if job.cells_processed == options.cell_limit or \
-               job.images_processed == options.image_limit:
+            if ledger is not None and image_path.prefix in ledger:
+                job.images_skipped += 1
+                continue
+            if options.cell_limit is not None and \
+               cells_written.value >= options.cell_limit:
                 break
+            if images_done == options.image_limit:
+                break
+            images_done += 1
+            in_flight.acquire()
             pool.apply_async(
                 job, [image_index, image_path],
-                callback=job.on_success,
-                error_callback=job.on_error)
+                callback=release(on_success),
+                error_callback=release(job.on_error))
     except KeyboardInterrupt:
         print()
     pool.close()
     pool.join()
+    if index_file is not None:
+        index_file.close()
 
     return job.images_processed, job.cells_processed, \
-           job.cell_counts, job.error_count
+           job.images_skipped, job.error_count
 
 
 def parse():
@@ -260,8 +463,22 @@ def parse():
     parser.add_argument('-m', '--masks', required=True)
     parser.add_argument('--cell-limit', type=int)
     parser.add_argument('--cell-count-csv')
+    parser.add_argument(
+        '--ledger',
+        help='Record of completed images, which are skipped when running '
+        'again (default: ledger.csv in the output directory)')
     parser.add_argument('--image-limit', type=int)
     parser.add_argument('--display', action='store_true')
+    parser.add_argument(
+        '--output-format',
+        choices=OUTPUT_FORMATS,
+        default='png',
+        help='One png per cell, or cells packed into shards for CellData')
+    parser.add_argument('--cells-per-shard', type=int, default=100000)
+    parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        help='Images queued at once (default: twice the number of CPUs)')
     return parser.parse_args()
 
 
@@ -272,18 +489,30 @@ def main():
     image_paths = parse_paths(options.metadata, options.pattern, options.masks,
                               options.image_path)
 
+    ledger = None
+    if not options.display:
+        ledger_path = options.ledger or os.path.join(options.output,
+                                                     'ledger.csv')
+        ledger = Ledger(ledger_path, options.cell_count_csv)
+        if len(ledger) > 0:
+            print('Resuming after {0:,} images in {1}'.format(
+                len(ledger), ledger_path))
+        if ledger.partial_images:
+            print('Redoing {0:,} partially written images'.format(
+                len(ledger.partial_images)))
+
     start = time.time()
-    stats = mask_images(image_paths, options)
-    images_processed, cells_processed, cell_counts, error_counts = stats
+    try:
+        stats = mask_images(image_paths, options, ledger)
+    finally:
+        if ledger is not None:
+            ledger.close()
+    images_processed, cells_processed, images_skipped, error_counts = stats
     elapsed = time.time() - start
-    print('Processed {0:,} images into {1:,} cells in {2:.2f}s ({3} errors)'.
-          format(images_processed, cells_processed, elapsed, error_counts))
-
-    if options.cell_count_csv:
-        with open(options.cell_count_csv, 'w') as file:
-            file.write('key, number_of_cells\n')
-            lines = ['{0},{1}\n'.format(k, c) for k, c in cell_counts.items()]
-            file.writelines(lines)
+    print('Processed {0:,} images into {1:,} cells in {2:.2f}s '
+          '({3:,} skipped, {4} errors)'.format(images_processed,
+                                               cells_processed, elapsed,
+                                               images_skipped, error_counts))
 
 
 if __name__ == '__main__':